@@ -14,35 +14,151 @@
 # limitations under the License.
 
 # -*- coding: utf-8 -*-
-import os
+import gzip
+import mmap
 import tempfile
+import threading
 import time
 from StringIO import StringIO
 
 import pandas as pd
 from gcloud import storage
 from retrying import retry
+from isb_cgc_user_data.bigquery_etl.transform.tools import write_df_for_load
+from isb_cgc_user_data.utils.credentials import get_credentials
+
+# Blobs bigger than this are downloaded to disk in ranges, not into memory
+# (override with UDU_LARGE_FILE_BYTES / UDU_DOWNLOAD_CHUNK_BYTES in the config):
+LARGE_FILE_BYTES = 256 * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 32 * 1024 * 1024
+
+
+# Storage clients are reused, keyed by project and credential file, so each
+# connector does not repeat the client setup. The client's http object is not
+# thread safe and files are processed on several threads, so clients are cached
+# per thread, along with the bucket handles made from them (a get_bucket round
+# trip each), which are kept for BUCKET_CACHE_SECONDS. This pays off because the
+# threads are long-lived: the worker's job threads, and the file pools that
+# uduprocessor keeps per job thread (see run_file_tasks). Credentials are passed
+# in explicitly, from the shared provider:
+BUCKET_CACHE_SECONDS = 600
+_client_cache = threading.local()
+
+
+def _thread_cache(name):
+    cache = getattr(_client_cache, name, None)
+    if cache is None:
+        cache = {}
+        setattr(_client_cache, name, cache)
+    return cache
+
+
+def get_storage_client(project, credential_path, logger=None):
+    key = (project, credential_path)
+    clients = _thread_cache('clients')
+    client = clients.get(key)
+    if client is None:
+        client = storage.Client(project, credentials=get_credentials(credential_path))
+        clients[key] = client
+        if logger:
+            logger.log_text("New storage client for {0} using {1}".format(project, credential_path), severity='INFO')
+    return client
+
+
+def get_cached_bucket(client, project, credential_path, bucket_name):
+    key = (project, credential_path, bucket_name)
+    now = time.time()
+    buckets = _thread_cache('buckets')
+    cached = buckets.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    bucket = client.get_bucket(bucket_name)
+    buckets[key] = (bucket, now + BUCKET_CACHE_SECONDS)
+    return bucket
+
+
+class MappedFile(object):
+    """Read-only, memory-mapped view of a downloaded temp file, so the
+    parsers read from the page cache instead of a Python string. Has the
+    file methods the parsers use; closing it deletes the temp file.
+    """
+    def __init__(self, temp_file):
+        self.temp_file = temp_file
+        self.name = temp_file.name
+        self._map = mmap.mmap(temp_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def closed(self):
+        return self.temp_file.closed
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._map) - self._map.tell()
+        return self._map.read(size)
+
+    def readline(self):
+        return self._map.readline()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def seek(self, pos, whence=0):
+        self._map.seek(pos, whence)
+
+    def tell(self):
+        return self._map.tell()
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+            self.temp_file.close()
+
+
+class StagingFile(object):
+    """Temp file that load data is staged in before upload, optionally
+    gzip compressed as it is written. BigQuery loads gzip files directly.
+    Keeps count of the bytes written in and the bytes that go out.
+    """
+    def __init__(self, temp_file, compress=False):
+        self.temp_file = temp_file
+        self.compress = compress
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._writer = gzip.GzipFile(fileobj=temp_file, mode='wb') if compress else temp_file
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._writer.write(data)
+
+    def finish(self):
+        """Flushes the compressor and rewinds, returning the file to upload"""
+        if self.compress:
+            # Closing the GzipFile writes the trailer but leaves temp_file open
+            self._writer.close()
+        self.temp_file.flush()
+        self.bytes_out = self.temp_file.tell()
+        self.temp_file.seek(0)
+        return self.temp_file
+
+    def close(self):
+        self.temp_file.close()
+
 
 class GcsConnector(object):
     """Google Cloud Storage Connector
     """
     def __init__(self, project, bucket_name, config, tempdir='/tmp', logger=None):
         # connect to the cloud bucket
-        current_cred = os.environ['GOOGLE_APPLICATION_CREDENTIALS']
-        if logger:
-            logger.log_text("Existing Google Credential: {0}".format(current_cred), severity='INFO')
-        new_cred = config['privatekey_path']
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = new_cred
-        if logger:
-            logger.log_text("New Google Credential: {0}".format(new_cred), severity='INFO')
-        self.client = storage.Client(project)
-        self.bucket = self.client.get_bucket(bucket_name)
+        self.project = project
+        self.credential_path = config['privatekey_path']
+        self.client = get_storage_client(project, self.credential_path, logger=logger)
+        self.bucket = self.get_bucket(bucket_name)
         self.tempdir = tempdir
         self.logger = logger
         self.config = config
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = current_cred
-        if logger:
-            logger.log_text("Restoring Google Credential: {0}".format(current_cred), severity='INFO')
+
+    def get_bucket(self, bucket_name):
+        return get_cached_bucket(self.client, self.project, self.credential_path, bucket_name)
 
     #--------------------------------------
     # uploads a file to the bucket
@@ -67,19 +183,28 @@ class GcsConnector(object):
     #-------------------------------------------
     # Download the file to disk or file-like object
     # if rollover is true , it writes to the disk
+    # if rollover is None, it writes to disk if the blob
+    # is bigger than the large file threshold
     #-------------------------------------------
-    def download_blob_to_file(self, blobname, rollover=False):
+    def download_blob_to_file(self, blobname, rollover=None):
         blobname = '/'.join(blobname)
         blob = self.bucket.get_blob(blobname)
 
         if not blob  :
            raise Exception ('No blob found for the key:' + str(blobname))
 
-        # if rollover is true, write to temp file on disk 
+        if rollover is None:
+           large_file_bytes = int(self.config.get('UDU_LARGE_FILE_BYTES', LARGE_FILE_BYTES))
+           rollover = blob.size is not None and blob.size > large_file_bytes
+
+        # if rollover is true, write to temp file on disk and memory-map it
         # if false, write to StringIO buffer
-        if rollover:
+        if rollover and blob.size:
+           if self.logger:
+               self.logger.log_text("Downloading {0} bytes to disk".format(blob.size), severity='INFO')
            temp_data_file = self.create_tempfile()
-           blob.download_to_filename(temp_data_file.name)
+           self.download_blob_in_ranges(blob, temp_data_file)
+           return MappedFile(temp_data_file)
         else:
            if self.logger:
                self.logger.log_text("StringIO", severity='INFO')
@@ -88,7 +213,33 @@ class GcsConnector(object):
 
         temp_data_file.seek(0)
 
-        return temp_data_file 
+        return temp_data_file
+
+    #-------------------------------------------
+    # Download a blob to a file in byte ranges. Each
+    # range is retried on its own, so a transient failure
+    # resumes from the last range written rather than
+    # starting the whole download over
+    #-------------------------------------------
+    def download_blob_in_ranges(self, blob, file_obj):
+        chunk_bytes = int(self.config.get('UDU_DOWNLOAD_CHUNK_BYTES', DOWNLOAD_CHUNK_BYTES))
+        offset = 0
+        while offset < blob.size:
+            end = min(offset + chunk_bytes, blob.size) - 1
+            file_obj.write(self.download_blob_range(blob, offset, end))
+            offset = end + 1
+        file_obj.flush()
+
+    @retry(wait_exponential_multiplier=2000, wait_exponential_max=10000, stop_max_attempt_number=5)
+    def download_blob_range(self, blob, start, end):
+        response, content = self.client.connection.http.request(
+            blob.media_link, 'GET', headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+        if response.status not in (200, 206) or len(content) != end - start + 1:
+            if self.logger:
+                self.logger.log_text("Retrying download of bytes {0}-{1}, status {2}".format(start, end, response.status),
+                                     severity='WARNING')
+            raise Exception('Download of bytes {0}-{1} failed with status {2}'.format(start, end, response.status))
+        return content
 
 
     #-------------------------------------------
@@ -157,35 +308,78 @@ class GcsConnector(object):
 
   
     #----------------------------------------
-    # Convert a dataframe into newline-delimited JSON string
-    #  -- should work for a small to medium files
-    # if rollover_file is true
-    # works only in a single bucket
+    # Convert a dataframe into newline-delimited JSON
+    # and upload it to the tmp bucket
     # set the object metadata
     #----------------------------------------
-    @retry(retry_on_result=retry_if_result_none, wait_exponential_multiplier=2000, wait_exponential_max=10000, stop_max_delay=60000, stop_max_attempt_number=3)
     def convert_df_to_njson_and_upload(self, df, destination_blobname, metadata={}, tmp_bucket='isb-cgc-dev'):
+        return self.convert_df_and_upload(df, destination_blobname, metadata=metadata, tmp_bucket=tmp_bucket)
+
+    #----------------------------------------
+    # Convert a dataframe into a BigQuery load format
+    # (NEWLINE_DELIMITED_JSON or CSV; CSV needs the schema)
+    # and upload it to the tmp bucket. The data is spooled
+    # to a temp file on disk (gzip compressed if compress is
+    # true) rather than built up as one string; the upload
+    # itself is retried in upload_staged_file
+    #----------------------------------------
+    def convert_df_and_upload(self, df, destination_blobname, source_format='NEWLINE_DELIMITED_JSON', schema=None,
+                              metadata={}, tmp_bucket='isb-cgc-dev', compress=False):
 
         if self.logger:
-            self.logger.log_text("Converting dataframe into a new-line delimited JSON file", severity='INFO')
+            self.logger.log_text("Converting dataframe into a {0} file".format(source_format), severity='INFO')
 
-        file_to_upload = StringIO()
+        staging = self.create_staging_file(compress)
+        write_df_for_load(df, staging, source_format, schema)
+        return self.upload_staging_file(staging, destination_blobname, metadata=metadata, tmp_bucket=tmp_bucket)
 
-        for i, rec in df.iterrows():
-            file_to_upload.write(rec.convert_objects(convert_numeric=False).to_json() + "\n")
-        file_to_upload.seek(0)
+    #-------------------------------------------
+    # create a temp file to stage load data in,
+    # gzip compressed if compress is true
+    #-------------------------------------------
+    def create_staging_file(self, compress=False):
+        return StagingFile(self.create_tempfile(), compress)
+
+    #----------------------------------------
+    # Upload a StagingFile to the tmp bucket and close it.
+    # Logs bytes written vs. bytes uploaded
+    #----------------------------------------
+    def upload_staging_file(self, staging, destination_blobname, metadata={}, tmp_bucket='isb-cgc-dev'):
+        try:
+            file_to_upload = staging.finish()
+            if self.logger:
+                self.logger.log_text("Staged {0}: {1} bytes in, {2} bytes out{3}".format(
+                    destination_blobname, staging.bytes_in, staging.bytes_out,
+                    ' (gzip)' if staging.compress else ''), severity='INFO')
+            content_type = 'application/gzip' if staging.compress else None
+            return self.upload_staged_file(file_to_upload, destination_blobname, metadata=metadata,
+                                           tmp_bucket=tmp_bucket, content_type=content_type)
+        finally:
+            staging.close()
 
-        bucket = self.client.get_bucket(tmp_bucket)
+    #----------------------------------------
+    # Upload an already serialized file to the tmp bucket
+    # (e.g. one spooled to disk chunk by chunk). Large files go
+    # up as a resumable upload, so a retry starts from a rewound file.
+    #----------------------------------------
+    @retry(retry_on_result=retry_if_result_none, wait_exponential_multiplier=2000, wait_exponential_max=10000, stop_max_delay=60000, stop_max_attempt_number=3)
+    def upload_staged_file(self, file_obj, destination_blobname, metadata={}, tmp_bucket='isb-cgc-dev', content_type=None):
+
+        if self.logger:
+            self.logger.log_text("Uploading staged file {0}".format(destination_blobname), severity='INFO')
+
+        bucket = self.get_bucket(tmp_bucket)
         upload_blob = storage.blob.Blob(destination_blobname, bucket=bucket)
+        upload_blob.upload_from_file(file_obj, rewind=True, content_type=content_type)
+        return self.finish_upload(upload_blob, destination_blobname, metadata)
 
-        upload_blob.upload_from_string(file_to_upload.getvalue())
+    def finish_upload(self, upload_blob, destination_blobname, metadata={}):
         # set blob metadata
         if metadata:
             if self.logger:
                 self.logger.log_text("Setting object metadata", severity='INFO')
             upload_blob.metadata = metadata
             upload_blob.patch()
-        file_to_upload.close()
 
         # check if the uploaded blob exists. Just a sanity check
         if upload_blob.exists():
@@ -193,8 +387,8 @@ class GcsConnector(object):
                 self.logger.log_text("The uploaded file {0} has size {1} bytes.".format(destination_blobname, upload_blob.size), severity='INFO')
             return True
         else:
-            raise Exception('File upload failed - {0}.'.format(destination_blobname)) 
-     
+            raise Exception('File upload failed - {0}.'.format(destination_blobname))
+
     def check_blob_exists(self, blob):
         """
         Checks if a blob exists
@@ -15,12 +15,101 @@
 # limitations under the License.
 
 
+import codecs
 import json
 import pandas as pd
 import re
+import tempfile
+from StringIO import StringIO
+import chardet
+from isb_cgc_user_data.bigquery_etl.extract.gcloud_wrapper import MappedFile
 from isb_cgc_user_data.utils.error_handling import UduException
 
-def convert_file_to_dataframe(filepath_or_buffer, sep="\t", skiprows=0, rollover=False, nrows=None, header=None, logger=None):
+ENCODING_BLOCK_BYTES = 1024 * 1024
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+# A well-formed multi-byte UTF-8 sequence. Text in a single-byte code page
+# (latin-1, windows-1252, ...) practically never contains one, so finding one
+# while converting from such a code page means the file mixes encodings:
+UTF8_MULTIBYTE_PATTERN = re.compile(r'[\xc2-\xdf][\x80-\xbf]|[\xe0-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}')
+
+
+def convert_buffer_encoding(filebuffer, new_coding='UTF-8', logger=None):
+    """detects the encoding once for the whole file and, if it is
+      not already new_coding, re-encodes the file before parsing.
+      Returns the buffer to parse (the same one if nothing changed).
+      Throws a UduException if the file is not all in one encoding
+    """
+    # Check the file a block at a time, stopping at the first byte
+    # that is not valid in the new coding:
+    decoder = codecs.getincrementaldecoder(new_coding)()
+    offset = 0
+    bad_offset = None
+    while True:
+        block = filebuffer.read(ENCODING_BLOCK_BYTES)
+        try:
+            decoder.decode(block, final=not block)
+        except UnicodeDecodeError as exp:
+            bad_offset = max(0, offset + exp.start)
+            break
+        if not block:
+            break
+        offset += len(block)
+    filebuffer.seek(0)
+
+    if bad_offset is None:
+        return filebuffer
+
+    # chardet only needs to see the text around the first bad byte:
+    filebuffer.seek(max(0, bad_offset - 1024))
+    sample = filebuffer.read(ENCODING_SAMPLE_BYTES)
+    filebuffer.seek(0)
+    encoding = chardet.detect(sample)['encoding']
+    if not encoding:
+        filebuffer.close()
+        raise UduException("Could not work out the text encoding of the file (near byte {0}). "
+                           "Please save it as UTF-8 and upload it again.".format(bad_offset))
+    if logger:
+        logger.log_text('Found {0} encoded file, converting to {1}'.format(encoding, new_coding), severity='INFO')
+
+    # Convert a block at a time, so the file is never held as one big string. A file that was
+    # downloaded to disk is converted to another file on disk:
+    if isinstance(filebuffer, MappedFile):
+        converted = tempfile.NamedTemporaryFile(bufsize=0, suffix='.converted')
+    else:
+        converted = StringIO()
+    decoder = codecs.getincrementaldecoder(encoding)()
+    offset = 0
+    try:
+        while True:
+            block = filebuffer.read(ENCODING_BLOCK_BYTES)
+            text = decoder.decode(block, final=not block)
+            if len(text) == len(block) and UTF8_MULTIBYTE_PATTERN.search(block):
+                raise UduException("File mixes UTF-8 and {0} encoded text. Please save it all as UTF-8 and "
+                                   "upload it again.".format(encoding))
+            converted.write(text.encode(new_coding))
+            if not block:
+                break
+            offset += len(block)
+    except UnicodeDecodeError as exp:
+        converted.close()
+        if logger:
+            logger.log_text('File could not be decoded as {0}: {1}'.format(encoding, str(exp)), severity='WARNING')
+        raise UduException("File is not all in one text encoding: byte {0} is not valid {1}. Please save it "
+                           "as UTF-8 and upload it again.".format(offset + exp.start, encoding))
+    except UduException:
+        converted.close()
+        raise
+    finally:
+        filebuffer.close()
+
+    converted.seek(0)
+    if isinstance(converted, StringIO):
+        return converted
+    return MappedFile(converted)
+
+
+def convert_file_to_dataframe(filepath_or_buffer, sep="\t", skiprows=0, rollover=False, nrows=None, header=None, names=None, logger=None):
     """does some required data cleaning and
       then converts into a dataframe
     """
@@ -36,25 +125,12 @@ def convert_file_to_dataframe(filepath_or_buffer, sep="\t", skiprows=0, rollover
         # EXCEPTION THROWN: TOO MANY FIELDS THROWS CParserError e.g. "Expected 207 fields in line 3, saw 208"
         # EXCEPTION THROWN: EMPTY FILE THROWS CParserError e.g. "Passed header=0 but only 0 lines in file"
         data_df = pd.read_table(filepath_or_buffer, sep=sep, skiprows=skiprows, lineterminator='\n',
-                                comment='#', na_values=na_values, dtype='object', nrows=nrows, header=header)
+                                comment='#', na_values=na_values, dtype='object', nrows=nrows, header=header,
+                                names=names)
+        check_row_width(data_df)
 
     except Exception as exp:
-        if logger:
-            logger.log_text("Read Table Error: {0}".format(str(exp.message)), severity='ERROR')
-
-        user_message = None
-        pattern = re.compile('^.* error: (.*)$')
-        match = pattern.match(str(exp.message))
-        if match:
-            err_guts = match.group(1)
-            if err_guts:
-                user_message = "Error parsing file: {0}. ".format(err_guts[:400])
-        if not user_message:
-            if "0 lines in file" in str(exp.message):
-                user_message = "File was empty"
-        if not user_message:
-            user_message = "Parsing error reading file"
-        raise UduException(user_message)
+        raise_parse_error(exp, logger)
 
     finally:
         filepath_or_buffer.close() # close  StringIO
@@ -62,6 +138,63 @@ def convert_file_to_dataframe(filepath_or_buffer, sep="\t", skiprows=0, rollover
     return data_df
 
 
+def convert_file_to_dataframe_chunks(filepath_or_buffer, chunksize, sep="\t", skiprows=0, header=None, names=None, logger=None):
+    """same as convert_file_to_dataframe, but yields dataframes of
+      at most chunksize rows so the whole table is never in memory
+    """
+    if logger:
+        logger.log_text("Converting file to dataframe chunks of {0} rows".format(chunksize), severity='INFO')
+
+    try:
+        na_values = ['none', 'None', 'NONE', 'null', 'Null', 'NULL', ' ', 'NA', '__UNKNOWN__', '?']
+
+        # Parsing errors may come out of any chunk, not just the first one:
+        reader = pd.read_table(filepath_or_buffer, sep=sep, skiprows=skiprows, lineterminator='\n',
+                               comment='#', na_values=na_values, dtype='object', header=header,
+                               names=names, chunksize=chunksize)
+        for data_df in reader:
+            check_row_width(data_df)
+            yield data_df
+
+    except Exception as exp:
+        raise_parse_error(exp, logger)
+
+    finally:
+        filepath_or_buffer.close()
+
+
+def check_row_width(data_df):
+    """pandas only rejects a row with more fields than the header when it is
+      not the first data row. If the first one is too long, the extra leading
+      fields silently become the index instead
+    """
+    if len(data_df.index) and not isinstance(data_df.index, pd.RangeIndex):
+        raise ValueError('Error tokenizing data. C error: Expected {0} fields in the first data row, saw {1}'.format(
+            len(data_df.columns), len(data_df.columns) + data_df.index.nlevels))
+
+
+def raise_parse_error(exp, logger=None):
+    """turns a pandas parsing exception into a UduException
+      with a message we can show the user
+    """
+    if logger:
+        logger.log_text("Read Table Error: {0}".format(str(exp.message)), severity='ERROR')
+
+    user_message = None
+    pattern = re.compile('^.* error: (.*)$')
+    match = pattern.match(str(exp.message))
+    if match:
+        err_guts = match.group(1)
+        if err_guts:
+            user_message = "Error parsing file: {0}. ".format(err_guts[:400])
+    if not user_message:
+        if "0 lines in file" in str(exp.message):
+            user_message = "File was empty"
+    if not user_message:
+        user_message = "Parsing error reading file"
+    raise UduException(user_message)
+
+
 #----------------------------------------
 # Convert newline-delimited JSON string to dataframe
 #  -- should work for a small to medium files
@@ -34,8 +34,8 @@ import time
 import uuid
 import os
 import re
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+from isb_cgc_user_data.bigquery_etl.transform.tools import CSV_NULL_MARKER
+from isb_cgc_user_data.bigquery_etl.utils.bigquery_service import get_bigquery_service
 from isb_cgc_user_data.utils import build_config
 from isb_cgc_user_data.utils.error_handling import UduException
 
@@ -51,8 +51,9 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
         google-api-client object
         source_schema: a valid bigquery schema,
         see https://cloud.google.com/bigquery/docs/reference/v2/tables
-        source_csv: the fully qualified Google Cloud Storage location of
-        the data to load into your table
+        source_path: the fully qualified Google Cloud Storage location of
+        the data to load into your table, or a list of them to load
+        several files in the one job
 
     Returns: a bigquery load job, see
     https://cloud.google.com/bigquery/docs/reference/v2/jobs#configuration.load
@@ -68,7 +69,7 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
         'configuration': {
             'load': {
                 'sourceFormat' : source_format,
-                'sourceUris': [source_path],
+                'sourceUris': source_path if isinstance(source_path, list) else [source_path],
                 'schema': {
                     'fields': source_schema
                 },
@@ -83,7 +84,14 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
             }
         }
     }
-    
+
+    # Our staged CSV files have no header row, quoted values may span lines, and NULLs
+    # are marked, so that empty strings are loaded as empty strings (see write_df_as_csv):
+    if source_format == 'CSV':
+        job_data['configuration']['load']['skipLeadingRows'] = 0
+        job_data['configuration']['load']['allowQuotedNewlines'] = True
+        job_data['configuration']['load']['nullMarker'] = CSV_NULL_MARKER
+
     return bigquery.jobs().insert(
         projectId=project_id,
         body=job_data).execute(num_retries=num_retries)
@@ -91,11 +99,23 @@ def load_table(bigquery, project_id, dataset_id, table_name, source_schema,
 
 
 # [START poll_job]
-def poll_job(bigquery, job, logger=None):
-    """Waits for a job to complete."""
+# Polling starts at poll_interval seconds and backs off by POLL_BACKOFF up to
+# max_interval. A job still running after deadline seconds is cancelled and given
+# up on, so it does not go on to load rows for a job we report as failed (and
+# does not read staged files that are about to be deleted).
+POLL_BACKOFF = 1.5
+POLL_MAX_SECONDS = 10
+LOAD_DEADLINE_SECONDS = 60 * 60
+
+
+def poll_job(bigquery, job, logger=None, poll_interval=1, max_interval=POLL_MAX_SECONDS,
+             deadline=LOAD_DEADLINE_SECONDS):
+    """Waits for a job to complete. Returns the seconds spent waiting."""
 
     print('Waiting for job to finish...')
 
+    start = time.time()
+    interval = poll_interval
     try:
         request = bigquery.jobs().get(
             projectId=job['jobReference']['projectId'],
@@ -110,6 +130,7 @@ def poll_job(bigquery, job, logger=None):
                     logger.log_text("Error loading BQtable: {0}".format(str(udu_ex.message)), severity='ERROR')
                 raise udu_ex
 
+            waited = time.time() - start
             if result['status']['state'] == 'DONE':
                 if 'errorResult' in result['status']:
                     udu_ex = UduException(str(result['status']['errorResult'])[:400])
@@ -117,16 +138,39 @@ def poll_job(bigquery, job, logger=None):
                         logger.log_text("Error loading BQtable upon completion: {0}".format(str(udu_ex.message)), severity='ERROR')
                     raise udu_ex
                 if logger:
-                    logger.log_text("BQtable job complete", severity='INFO')
-                return
+                    logger.log_text("BQtable job complete, waited {0:.1f} seconds".format(waited), severity='INFO')
+                return waited
 
-            time.sleep(1)
+            if waited + interval > deadline:
+                udu_ex = UduException("BigQuery load did not finish within {0} seconds".format(int(deadline)))
+                if logger:
+                    logger.log_text("Gave up waiting on BQtable job {0} after {1:.1f} seconds".format(
+                        job['jobReference']['jobId'], waited), severity='ERROR')
+                cancel_job(bigquery, job, logger)
+                raise udu_ex
+
+            time.sleep(interval)
+            interval = min(interval * POLL_BACKOFF, max_interval)
 
     except UduException as udu:
         raise udu
 
     except Exception as exp:
         handle_bq_exception(exp, logger)
+
+
+def cancel_job(bigquery, job, logger=None):
+    """Asks BigQuery to cancel a job. Failures are only logged."""
+    try:
+        bigquery.jobs().cancel(
+            projectId=job['jobReference']['projectId'],
+            jobId=job['jobReference']['jobId']).execute(num_retries=2)
+        if logger:
+            logger.log_text("Cancelled BQtable job {0}".format(job['jobReference']['jobId']), severity='INFO')
+    except Exception as exp:
+        if logger:
+            logger.log_text("Could not cancel BQtable job {0}: {1}".format(
+                job['jobReference']['jobId'], str(exp)), severity='WARNING')
 # [END poll_job]
 
 
@@ -135,16 +179,8 @@ def run(config, project_id, dataset_id, table_name, schema_file, data_path,
          source_format='NEWLINE_DELIMITED_JSON', write_disposition='WRITE_EMPTY',
          num_retries=5, poll_interval=1, is_schema_file=True, logger=None):
     # [START build_service]
-    # Grab the application's default credentials from the environment.
-
-    current_cred = os.environ['GOOGLE_APPLICATION_CREDENTIALS']
-    new_cred = config['privatekey_path']
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = new_cred
-    credentials = GoogleCredentials.get_application_default()
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = current_cred
-
-    # Construct the service object for interacting with the BigQuery API.
-    bigquery = discovery.build('bigquery', 'v2', credentials=credentials)
+    # The service object for interacting with the BigQuery API is built once (per thread) and cached.
+    bigquery = get_bigquery_service(config['privatekey_path'], logger)
     # [END build_service]
 
     if is_schema_file:
@@ -168,8 +204,11 @@ def run(config, project_id, dataset_id, table_name, schema_file, data_path,
     except Exception as exp:
         handle_bq_exception(exp, logger)
 
-    poll_job(bigquery, job, logger)
-    
+    # Returns the seconds spent waiting on the load:
+    return poll_job(bigquery, job, logger, poll_interval=poll_interval,
+                    max_interval=float(config.get('UDU_BQ_POLL_MAX_SECONDS', POLL_MAX_SECONDS)),
+                    deadline=float(config.get('UDU_BQ_LOAD_DEADLINE_SECONDS', LOAD_DEADLINE_SECONDS)))
+
 # [END run]
 
 
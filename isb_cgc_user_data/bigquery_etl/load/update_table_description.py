@@ -19,8 +19,7 @@ import time
 import uuid
 import sys
 import os
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+from isb_cgc_user_data.bigquery_etl.utils.bigquery_service import get_bigquery_service
 from isb_cgc_user_data.utils import build_config
 
 def update_table_description(bigquery, project_id, dataset_id, table_name, table_description):
@@ -45,15 +44,8 @@ def update_table_description(bigquery, project_id, dataset_id, table_name, table
 
 def main(config, project_id, dataset_id, table_name, descriptions_file):
 
-    current_cred = os.environ['GOOGLE_APPLICATION_CREDENTIALS']
-    new_cred = config['privatekey_path']
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = new_cred
-    # Grab the application's default credentials from the environment.
-    credentials = GoogleCredentials.get_application_default()
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = current_cred
-
-    # Construct the service object for interacting with the BigQuery API.
-    bigquery = discovery.build('bigquery', 'v2', credentials=credentials)
+    # The service object for interacting with the BigQuery API is cached (per thread).
+    bigquery = get_bigquery_service(config['privatekey_path'])
     # [END build_service]
 
     with open(descriptions_file, 'r') as f:
@@ -0,0 +1,663 @@
+#!/usr/bin/env python
+
+# Copyright 2017, Institute for Systems Biology.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks and checks for the upload processing steps, on synthetic data.
+
+Run from the repository root:
+
+    python -m isb_cgc_user_data.bigquery_etl.tests.benchmarks [name ...] [--scale N]
+
+With no names, everything runs. Where a step was rewritten, the implementation
+it replaced is kept here (as *_baseline) and both are timed. Each case runs in a
+child process, so its peak memory is measured on its own. --scale multiplies the
+data sizes (the baselines get slow and large quickly).
+"""
+
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import multiprocessing
+import re
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from StringIO import StringIO
+
+import chardet
+import numpy as np
+import pandas as pd
+
+from isb_cgc_user_data.bigquery_etl.extract.gcloud_wrapper import GcsConnector
+from isb_cgc_user_data.bigquery_etl.extract.utils import convert_file_to_dataframe, convert_file_to_dataframe_chunks
+from isb_cgc_user_data.bigquery_etl.transform.tools import cleanup_dataframe, convert_encoding, CSV_NULL_MARKER
+from isb_cgc_user_data.bigquery_etl.utils import convert_gbq_to_df, sync_query
+from isb_cgc_user_data.user_gen import metadata_updates
+from isb_cgc_user_data.user_gen.bigquery_table_schemas import get_molecular_schema
+from isb_cgc_user_data.user_gen.metadata_updates import MetadataWriter, insert_metadata_samples
+from isb_cgc_user_data.user_gen.molecular_processing import melt_molecular_dataframe, get_column_mapping
+from isb_cgc_user_data.utils.check_dataframe_dups import reject_row_duplicate_or_blank, sniff_header
+from isb_cgc_user_data.utils.error_handling import UduException
+
+MOLECULAR_METADATA = {
+    'project_id': 1,
+    'platform': 'benchmark platform',
+    'pipeline': 'benchmark pipeline'
+}
+
+
+#
+# Measurement helpers
+#
+
+def _rss_kb(field):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def _reset_peak_rss():
+    # Linux: resets VmHWM to the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def _measured_child(setup, func, results):
+    try:
+        inputs = setup()
+        _reset_peak_rss()
+        start_rss = _rss_kb('VmRSS')
+        start = time.time()
+        output = func(*inputs)
+        seconds = time.time() - start
+        results.put((seconds, (_rss_kb('VmHWM') - start_rss) / 1024.0, output))
+    except Exception as exp:
+        results.put(exp)
+        raise
+
+
+def measure(setup, func):
+    """Runs func(*setup()) in a child process. Returns the wall-clock seconds,
+    the peak memory (MB above the RSS once the inputs were built) and func's
+    return value (which must pickle; keep it small).
+    """
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_measured_child, args=(setup, func, results))
+    child.start()
+    result = results.get()
+    child.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def report(name, seconds, peak_mb, extra=''):
+    print '  {0:<28} {1:9.2f} s {2:9.1f} MB peak  {3}'.format(name, seconds, peak_mb, extra)
+
+
+#
+# user-001: wide-to-long reshape of a molecular matrix
+#
+
+def melt_baseline(data_df, column_map, metadata):
+    """The per-cell loop parse_file used to reshape with"""
+    new_df_data = []
+    map_values = {}
+    for i, j in data_df.iteritems():
+        if i in column_map.keys():
+            map_values[column_map[i]] = [k for d, k in j.iteritems()]
+        else:
+            for k, m in j.iteritems():
+                new_df_obj = {}
+                new_df_obj['sample_barcode'] = i
+                new_df_obj['project_id'] = metadata['project_id']
+                new_df_obj['Platform'] = metadata['platform']
+                new_df_obj['Pipeline'] = metadata['pipeline']
+                new_df_obj['Symbol'] = map_values['Symbol'][k] if 'Symbol' in map_values.keys() else ''
+                new_df_obj['ID'] = map_values['ID'][k] if 'ID' in map_values.keys() else ''
+                new_df_obj['TAB'] = map_values['Tab'][k] if 'Tab' in map_values.keys() else ''
+                new_df_obj['Level'] = m
+                new_df_data.append(new_df_obj)
+    return pd.DataFrame(new_df_data)
+
+
+def molecular_matrix(data_type, features, samples):
+    """A cleaned matrix (all values strings, as cleanup_dataframe leaves them)"""
+    rng = np.random.RandomState(0)
+    columns = {}
+    if data_type == 'mrna':
+        key_columns = ['Name', 'Description']
+        columns['Name'] = ['ENSG{0:011d}'.format(i) for i in xrange(features)]
+        columns['Description'] = ['GENE{0}'.format(i) for i in xrange(features)]
+    else:
+        key_columns = ['Probe_ID']
+        columns['Probe_ID'] = ['cg{0:08d}'.format(i) for i in xrange(features)]
+    sample_columns = ['SAMPLE-{0:04d}'.format(i) for i in xrange(samples)]
+    for sample in sample_columns:
+        columns[sample] = rng.rand(features).round(6).astype(str).astype(object)
+    return pd.DataFrame(columns, columns=key_columns + sample_columns)
+
+
+def _melt_case(melt, data_type, features, samples):
+    def setup():
+        return molecular_matrix(data_type, features, samples), get_column_mapping(data_type), MOLECULAR_METADATA
+
+    def run(data_df, column_map, metadata):
+        new_df = melt(data_df, column_map, metadata)
+        columns = sorted(new_df.columns)
+        return len(new_df.index), columns, int(pd.util.hash_pandas_object(new_df[columns], index=False).sum())
+
+    return setup, run
+
+
+def bench_melt(scale):
+    cases = [('mrna', 20000 * scale, 25), ('meth', 100000 * scale, 10)]
+    for data_type, features, samples in cases:
+        print 'melt {0}: {1} features x {2} samples'.format(data_type, features, samples)
+        shapes = []
+        for name, melt in (('baseline (dict per cell)', melt_baseline), ('melt_molecular_dataframe', melt_molecular_dataframe)):
+            seconds, peak_mb, shape = measure(*_melt_case(melt, data_type, features, samples))
+            report(name, seconds, peak_mb, '{0} rows'.format(shape[0]))
+            shapes.append(shape)
+        assert shapes[0] == shapes[1], 'reshaped tables differ'
+
+
+#
+# user-003: dataframe cleanup
+#
+
+def convert_encoding_baseline(text, new_coding='UTF-8', logger=None):
+    """convert_encoding as it was, verbatim: chardet decides, even for values
+    that are already valid UTF-8
+    """
+    if isinstance(text, (int, float)):
+        text = str(text)
+
+    if all([True if ord(i) < 128 else False for i in text]):
+        return text
+
+    try:
+        encoding = chardet.detect(text)['encoding']
+        if logger:
+            logger.log_text('Found {0} encoded string - {1}'.format(encoding, text), severity='DEBUG')
+        if new_coding.upper() != encoding.upper():
+            text = text.decode(encoding, text).encode(new_coding)
+            if logger:
+                logger.log_text('New {0} encoded string - {1}'.format(new_coding, text), severity='DEBUG')
+        return text
+    except Exception as e:
+        if logger:
+            logger.log_text("Could not be decoded. Encoding failed because {0}".format(str(e)), severity='ERROR')
+        pass
+
+    # decode to ascii-ignore and then encode to utf-8( default if others fail)
+    # remove the non-ascii characters if the above steps fail
+    try:
+        text = text.decode('ascii', 'ignore').encode(new_coding)
+    except Exception as e:
+        if logger:
+            logger.log_text("Could not be :ascii ignored:. Encoding failed because {0}".format(str(e)), severity='ERROR')
+        text = re.sub(r'[^\x00-\x7F]+', ' ', text)
+    return text
+
+
+def cleanup_baseline(df):
+    """The applymap chain cleanup_dataframe used to run (values only)"""
+    na_values = ['none', 'None', 'NONE', 'null', 'Null', 'NULL', ' ', 'NA', '__UNKNOWN__', '?']
+    for rep in na_values:
+        df = df.replace(rep, np.nan)
+    df = df.applymap(lambda x: np.nan if isinstance(x, basestring) and x.isspace() else x)
+    df = df.fillna("__missing__value__")
+    df = df.applymap(lambda x: convert_encoding_baseline(x))
+    df = df.applymap(lambda x: str(x).strip())
+    df = df.applymap(lambda x: str(x).strip("'"))
+    df = df.applymap(lambda x: str(x).strip('"'))
+    df = df.replace(r'__missing__value__', np.nan)
+    return df
+
+
+#
+# Intended change: a value that is already valid UTF-8 is kept as it is. chardet used to
+# guess on every non-ASCII value, and on short strings it often guessed a single-byte
+# coding for UTF-8 text, which then got encoded a second time. Latin-1 values are still
+# converted to UTF-8 as before. (input, expected output):
+#
+
+ENCODING_CASES = [
+    ('plain', 'plain'),
+    ('caf\xe9', 'caf\xc3\xa9'),
+    ('M\xfcller', 'M\xc3\xbcller'),
+    ('r\xe9sum\xe9', 'r\xc3\xa9sum\xc3\xa9'),
+    ('Nombre espa\xf1ol', 'Nombre espa\xc3\xb1ol'),
+    ('caf\xc3\xa9', 'caf\xc3\xa9'),
+    ('Nombre espa\xc3\xb1ol', 'Nombre espa\xc3\xb1ol'),
+    ('\xc3\xa9t\xc3\xa9 fran\xc3\xa7ais', '\xc3\xa9t\xc3\xa9 fran\xc3\xa7ais'),
+]
+
+
+def check_encoding_cases():
+    for text, expected in ENCODING_CASES:
+        converted = convert_encoding(text)
+        assert converted == expected, 'convert_encoding({0!r}) gave {1!r}'.format(text, converted)
+        before = convert_encoding_baseline(text)
+        if before != expected:
+            print '  {0!r}: was {1!r}, now {2!r}'.format(text, before, converted)
+
+
+def _is_utf8_text(value):
+    if not isinstance(value, str) or all(ord(char) < 128 for char in value):
+        return False
+    try:
+        value.decode('utf-8')
+        return True
+    except UnicodeError:
+        return False
+
+
+def user_gen_frame(rows, text_columns=10, number_columns=10):
+    """Parsed upload with the values cleanup has to deal with: NA tokens, blanks,
+    padding, quotes, a few non-ASCII names and float columns with gaps
+    """
+    rng = np.random.RandomState(0)
+    tokens = np.array(['value', ' padded ', "'quoted'", '"double"', 'NA', 'None', '?', '   ', '',
+                       'caf\xc3\xa9', 'Nombre espa\xc3\xb1ol', '42', '3.14'], dtype=object)
+    columns = {}
+    names = []
+    for i in xrange(text_columns):
+        name = 'text_{0}'.format(i)
+        values = tokens[rng.randint(0, len(tokens), rows)]
+        values[rng.rand(rows) < 0.05] = np.nan
+        columns[name] = values
+        names.append(name)
+    for i in xrange(number_columns):
+        name = 'number_{0}'.format(i)
+        values = rng.rand(rows) * 1000
+        values[rng.rand(rows) < 0.05] = np.nan
+        columns[name] = values
+        names.append(name)
+    return pd.DataFrame(columns, columns=names)
+
+
+def _frame_digest(df, ignore=None):
+    if ignore is not None:
+        df = df.mask(ignore)
+    return len(df.index), int(pd.util.hash_pandas_object(df, index=False).sum())
+
+
+def bench_cleanup(scale):
+    print 'convert_encoding: {0} latin-1 and UTF-8 cases'.format(len(ENCODING_CASES))
+    check_encoding_cases()
+
+    rows = 50000 * scale
+    print 'cleanup: {0} rows x 20 columns'.format(rows)
+
+    # The already-UTF-8 cells are left out of the comparison (see ENCODING_CASES):
+    def setup():
+        df = user_gen_frame(rows)
+        return df, df.applymap(_is_utf8_text)
+
+    seconds, peak_mb, baseline = measure(setup, lambda df, ignore: _frame_digest(cleanup_baseline(df), ignore))
+    report('baseline (applymap chain)', seconds, peak_mb)
+    seconds, peak_mb, current = measure(setup, lambda df, ignore: _frame_digest(cleanup_dataframe(df), ignore))
+    report('cleanup_dataframe', seconds, peak_mb)
+    assert baseline == current, 'cleaned values differ'
+
+
+#
+# user-007: gzip staging of load files
+#
+
+class FakeBucketConnector(GcsConnector):
+    """GcsConnector whose uploads land in a dict instead of a bucket"""
+    def __init__(self):
+        self.logger = None
+        self.tempdir = tempfile.gettempdir()
+        self.blobs = {}
+
+    def upload_staged_file(self, file_obj, destination_blobname, metadata={}, tmp_bucket=None, content_type=None):
+        file_obj.seek(0)
+        self.blobs[destination_blobname] = (file_obj.read(), content_type)
+        return True
+
+
+def load_rows(content, source_format, schema):
+    """Reads a staged file back the way the load job does: gzip is recognized
+    from the content, CSV fields are matched to the schema by position
+    """
+    if content.startswith('\x1f\x8b'):
+        content = gzip.GzipFile(fileobj=StringIO(content)).read()
+    if source_format == 'CSV':
+        names = [field['name'] for field in schema]
+        return [[(name, None if value == CSV_NULL_MARKER else value) for name, value in zip(names, row)]
+                for row in csv.reader(StringIO(content))]
+    return [sorted(json.loads(line).items()) for line in content.splitlines()]
+
+
+def staging_frame(samples):
+    """Melted molecular rows, some with empty Symbol values and missing levels"""
+    df = melt_molecular_dataframe(molecular_matrix('mrna', 20000, samples), get_column_mapping('mrna'), MOLECULAR_METADATA)
+    df.loc[df.index % 7 == 0, 'Symbol'] = ''
+    df.loc[df.index % 11 == 0, 'Level'] = np.nan
+    return df
+
+
+def _staging_case(samples, source_format, compress):
+    def run(df):
+        gcs = FakeBucketConnector()
+        gcs.convert_df_and_upload(df, 'staged.out', source_format=source_format, schema=get_molecular_schema(),
+                                  compress=compress)
+        content, content_type = gcs.blobs['staged.out']
+        rows = load_rows(content, source_format, get_molecular_schema())
+        return len(content), content_type, len(rows), hashlib.md5(repr(rows)).hexdigest()
+
+    return (lambda: (staging_frame(samples),)), run
+
+
+def check_staging(scale):
+    samples = 10 * scale
+    for source_format in ('NEWLINE_DELIMITED_JSON', 'CSV'):
+        print 'staging {0}: 20000 features x {1} samples'.format(source_format, samples)
+        loaded = []
+        for compress in (False, True):
+            seconds, peak_mb, (size, content_type, rows, digest) = measure(*_staging_case(samples, source_format, compress))
+            report('gzip' if compress else 'plain', seconds, peak_mb,
+                   '{0} rows, {1:.1f} MB staged, {2}'.format(rows, size / 1048576.0, content_type))
+            loaded.append((rows, digest))
+        assert loaded[0] == loaded[1], 'gzip staging loads different rows'
+
+
+#
+# user-012: metadata_samples inserts
+#
+
+class FakeCursor(object):
+    """Keeps a digest of the statements and parameters a flush sends"""
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.digest = hashlib.md5()
+
+    def execute(self, statement, params=None):
+        self.statements += 1
+        self.digest.update(statement)
+        if params:
+            self.rows += len(params)
+            # The old row builder left NaN in float columns; the driver sent those as NULL too
+            self.digest.update(repr([None if value != value else value for value in params]))
+
+    def close(self):
+        pass
+
+
+class FakeDb(object):
+    def __init__(self):
+        self.cursors = []
+
+    def cursor(self):
+        self.cursors.append(FakeCursor())
+        return self.cursors[-1]
+
+    def commit(self):
+        pass
+
+
+def insert_metadata_samples_baseline(config, data_df, table, writer=None):
+    """The transpose and one-row slice per sample insert_metadata_samples used to do"""
+    columns = list(data_df.columns.values)
+    data_df = data_df.where((pd.notnull(data_df)), None)
+    value_list = []
+    for i, j in data_df.transpose().iteritems():
+        row = data_df[i:i+1]
+        value_list.append(tuple(row.values[0]))
+    writer.insert(table, columns, value_list)
+
+
+def metadata_samples_frame(samples):
+    """A merged user_gen frame: barcodes, text and float columns, has_* flags"""
+    df = user_gen_frame(samples)
+    df.insert(0, 'sample_barcode', ['SAMPLE-{0:07d}'.format(i) for i in xrange(samples)])
+    df.insert(1, 'case_barcode', 'cgc_' + df['sample_barcode'])
+    for flag in ('has_mrna', 'has_mirna', 'has_protein', 'has_meth'):
+        df[flag] = 0
+    return df
+
+
+def _insert_case(insert, samples):
+    def run(df):
+        db = FakeDb()
+
+        @contextmanager
+        def fake_connection(config):
+            yield db
+
+        metadata_updates.cloudsql_connection = fake_connection
+        with open('/dev/null', 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                writer = MetadataWriter({})
+                insert({}, df, 'metadata_samples', writer=writer)
+                writer.flush()
+            finally:
+                sys.stdout = stdout
+        cursor = db.cursors[0]
+        return cursor.statements, cursor.rows, cursor.digest.hexdigest()
+
+    return (lambda: (metadata_samples_frame(samples),)), run
+
+
+def bench_insert(scale):
+    print 'metadata_samples insert: 26 columns, statements sent to a fake connection'
+    for samples in (1000 * scale, 4000 * scale, 16000 * scale):
+        print '  {0} samples'.format(samples)
+        sent = []
+        for name, insert in (('baseline (slice per row)', insert_metadata_samples_baseline),
+                             ('insert_metadata_samples', insert_metadata_samples)):
+            seconds, peak_mb, (statements, values, digest) = measure(*_insert_case(insert, samples))
+            report(name, seconds, peak_mb, '{0} statements, {1:.0f} us/sample'.format(statements, seconds * 1e6 / samples))
+            sent.append((statements, values, digest))
+        assert sent[0] == sent[1], 'inserted rows differ'
+
+
+#
+# user-020: paging through query results
+#
+
+class FakeRequest(object):
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self, num_retries=0):
+        return self.result
+
+
+class FakeQueryJobs(object):
+    """Serves `pages` copies of one synthetic result page"""
+    def __init__(self, pages, page_rows):
+        self.pages = pages
+        fields = [{'name': 'sample_barcode', 'type': 'STRING'}, {'name': 'feature', 'type': 'STRING'},
+                  {'name': 'value', 'type': 'FLOAT'}, {'name': 'count', 'type': 'INTEGER'}]
+        rows = [{'f': [{'v': 'SAMPLE-{0:04d}'.format(i % 1000)}, {'v': 'GENE{0}'.format(i)},
+                       {'v': None if i % 13 == 0 else repr(i / 7.0)}, {'v': str(i)}]} for i in xrange(page_rows)]
+        self.page = {'schema': {'fields': fields}, 'rows': rows}
+
+    def query(self, projectId, body):
+        return FakeRequest({'jobReference': {'projectId': projectId, 'jobId': 'benchmark'}})
+
+    def getQueryResults(self, pageToken=None, **job_reference):
+        number = int(pageToken or 0) + 1
+        page = dict(self.page)
+        if number < self.pages:
+            page['pageToken'] = str(number)
+        return FakeRequest(page)
+
+
+class FakeBigQuery(object):
+    def __init__(self, pages, page_rows):
+        self._jobs = FakeQueryJobs(pages, page_rows)
+
+    def jobs(self):
+        return self._jobs
+
+
+def query_to_df_baseline(bigquery, project_id, query):
+    """What convert_gbq_to_df.run used to do: sync_query.main's paging loop
+    (one dict per row, the result list copied on every page), then a DataFrame
+    built from the dicts
+    """
+    query_job = sync_query.sync_query(bigquery, project_id, query)
+    results = list()
+    page_token = None
+    while True:
+        page = bigquery.jobs().getQueryResults(
+            pageToken=page_token,
+            **query_job['jobReference']).execute(num_retries=2)
+        fields = page['schema']['fields']
+        page_results = []
+        for row in page['rows']:
+            row_results = {}
+            for i in xrange(0, len(fields)):
+                row_results[fields[i]['name']] = row['f'][i]['v']
+            page_results.append(row_results)
+        results = results + page_results
+        page_token = page.get('pageToken')
+        if not page_token:
+            break
+    data_df = pd.DataFrame(results)
+    return data_df.fillna(value=np.nan)
+
+
+def _query_digest(df):
+    return len(df.index), sorted(df.columns), round(df['value'].astype(float).sum(), 3)
+
+
+def _query_case(to_df, pages, page_rows):
+    def setup():
+        return FakeBigQuery(pages, page_rows),
+
+    def run(bigquery):
+        sync_query.get_bigquery_service = lambda credential_path, logger=None: bigquery
+        with open('/dev/null', 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                return _query_digest(to_df(bigquery))
+            finally:
+                sys.stdout = stdout
+
+    return setup, run
+
+
+def bench_query_pages(scale):
+    page_rows = 10000
+    print 'query results to dataframe: pages of {0} rows x 4 columns'.format(page_rows)
+    for pages in (10 * scale, 20 * scale, 40 * scale):
+        print '  {0} pages'.format(pages)
+        frames = []
+        for name, to_df in (('baseline (row dicts)', lambda bigquery: query_to_df_baseline(bigquery, 'p', 'q')),
+                            ('convert_gbq_to_df.run', lambda bigquery: convert_gbq_to_df.run({'privatekey_path': None}, 'p', 'q'))):
+            seconds, peak_mb, digest = measure(*_query_case(to_df, pages, page_rows))
+            report(name, seconds, peak_mb, '{0:.2f} us/row'.format(seconds * 1e6 / (pages * page_rows)))
+            frames.append(digest)
+        assert frames[0] == frames[1], 'dataframes differ'
+
+
+#
+# user-014: header sniffing and parsing
+#
+
+# (file, expected rows, or the expected UduException message)
+PARSE_CASES = [
+    ('ID\tS1\tS2\ng1\t1\t2\ng2\t3\t4\n', [['g1', '1', '2'], ['g2', '3', '4']]),
+    ('\xef\xbb\xbf# comment\n\nID\tS1\tS2\ng1\t1\t2\n', [['g1', '1', '2']]),
+    ('ID,S1,S2\ng1,1,2\n', [['g1', '1', '2']]),
+    ('ID\tS1\tS2\ng1\t1\ng2\t3\t4\n', [['g1', '1', None], ['g2', '3', '4']]),
+    ('ID\tS1\tS2\ng1\t1\t2\ng2\t3\t4\t9\n', 'Error parsing file: Expected 3 fields in line 3, saw 4. '),
+    ('# comment\nID\tS1\tS2\ng1\t1\t2\ng2\t3\t4\t9\n', 'Error parsing file: Expected 3 fields in line 4, saw 4. '),
+    ('ID\tS1\tS2\ng1\t1\t2\t9\ng2\t3\t4\n', 'Error parsing file: Expected 3 fields in the first data row, saw 4. '),
+]
+
+
+def _parse(text, chunked):
+    buffer = StringIO(text)
+    columns, sep, header_line = sniff_header(buffer, None, 'barcode')
+    if chunked:
+        frames = list(convert_file_to_dataframe_chunks(buffer, 1000, sep=sep, header=0, names=columns))
+        data_df = pd.concat(frames)
+    else:
+        data_df = convert_file_to_dataframe(buffer, sep=sep, header=0, names=columns)
+    assert list(data_df.columns) == columns
+    return data_df.where(pd.notnull(data_df), None).values.tolist()
+
+
+def check_parse(scale):
+    print 'parse: {0} files, whole and in chunks'.format(len(PARSE_CASES))
+    for text, expected in PARSE_CASES:
+        for chunked in (False, True):
+            try:
+                result = _parse(text, chunked)
+            except UduException as exp:
+                result = exp.message
+            assert result == expected, '{0!r} (chunked: {1}): got {2!r}'.format(text, chunked, result)
+
+    # The bad rows are logged with their line in the file, after any lines skipped above the header:
+    text = '\xef\xbb\xbf# comment\n\nID\tS1\ng1\t1\ng2\t2\ng1\t3\n'
+    logger = _ListLogger()
+    buffer = StringIO(text)
+    columns, sep, header_line = sniff_header(buffer, None, 'barcode')
+    data_df = convert_file_to_dataframe(buffer, sep=sep, header=0, names=columns)
+    try:
+        reject_row_duplicate_or_blank(data_df, logger, 'feature', 0, header_line=header_line)
+    except UduException:
+        pass
+    assert "line 6: duplicated 'g1'" in logger.texts[0], logger.texts
+
+
+class _ListLogger(object):
+    def __init__(self):
+        self.texts = []
+
+    def log_text(self, text, severity=None):
+        self.texts.append(text)
+
+
+BENCHMARKS = [
+    ('melt', bench_melt),
+    ('cleanup', bench_cleanup),
+    ('staging', check_staging),
+    ('insert', bench_insert),
+    ('query', bench_query_pages),
+    ('parse', check_parse),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='benchmarks to run: {0}'.format(', '.join(name for name, _ in BENCHMARKS)))
+    parser.add_argument('--scale', type=int, default=1, help='data size multiplier')
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS:
+        if not args.names or name in args.names:
+            bench(args.scale)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,10 @@ from StringIO import StringIO
 import chardet
 from isb_cgc_user_data.utils.error_handling import UduException
 
+NON_ASCII_PATTERN = re.compile(r'[^\x00-\x7F]')
+NJSON_BLOCK_ROWS = 100000
+CSV_NULL_MARKER = '\\N'
+
 
 #--------------------------------------
 # Clean up the dataframe
@@ -40,36 +44,15 @@ def cleanup_dataframe(df, logger=None):
         logger.log_text("Encountered empty dataframe", severity='ERROR')
         raise UduException("Uploaded file only contained header row")
 
-    # why again, we are doing it in convert_to_dataframe, right?
-    # because we can call this function separately
-    na_values = ['none', 'None', 'NONE', 'null', 'Null', 'NULL', ' ', 'NA', '__UNKNOWN__', '?']
-    for rep in na_values:
-        df = df.replace(rep, np.nan)
-
-    # remove empty spaces(this removes more than 1 space)
-    df = df.applymap(lambda x: np.nan if isinstance(x, basestring) and x.isspace() else x)
-
-    #we dont want to play with nan(numpy.nan) or empty values
-    df = df.fillna("__missing__value__")
-
-    # convert to utf-8
-    df = df.applymap(lambda x: convert_encoding(x, logger))
-
-    # strip every value(this should get rid of ^M too)
-    df = df.applymap(lambda x: str(x).strip())
-
-    # strip every value of single quotes
-    df = df.applymap(lambda x: str(x).strip("'"))
-
-    # strip every value of double quotes
-    df = df.applymap(lambda x: str(x).strip('"'))
+    # Clean one column at a time with vectorized string operations,
+    # rather than making a pass over every cell for each step:
+    cleaned_df = pd.concat([clean_column(df.iloc[:, i], logger) for i in range(len(df.columns))], axis=1)
+    cleaned_df.columns = df.columns
+    df = cleaned_df
 
     # strip column names too
     df.columns = df.columns.map(lambda x: x.strip())
 
-    # replace back with np.nan
-    df = df.replace(r'__missing__value__', np.nan)
-
     #------------
     # Fix columns
     #------------
@@ -92,6 +75,52 @@ def cleanup_dataframe(df, logger=None):
         df.columns = df.columns.map(lambda x: x.replace(repl, replace_column_strings[repl]))
     return df
 
+#--------------------------------------
+# Clean up a single column:
+#   - NA tokens and whitespace-only values -> nan
+#   - non-ASCII values are run through convert_encoding
+#   - everything else is str()'d and stripped of whitespace, then
+#     single quotes, then double quotes
+# Numeric columns are just str()'d: that leaves nothing else to clean
+#--------------------------------------
+def clean_column(column, logger=None):
+    # why again, we are doing it in convert_to_dataframe, right?
+    # because we can call this function separately
+    na_values = ['none', 'None', 'NONE', 'null', 'Null', 'NULL', ' ', 'NA', '__UNKNOWN__', '?']
+
+    cleaned = np.empty(len(column), dtype=object)
+    cleaned[:] = np.nan
+
+    present = (column.notnull() & ~column.isin(na_values)).values
+    text = column[present]
+
+    if text.dtype.kind in 'biuf':
+        # str() of a float keeps 12 significant digits; astype(str) would give the full repr:
+        cleaned[present] = text.map(str).values
+        return pd.Series(cleaned, index=column.index, name=column.name)
+
+    text = text.astype(str)
+
+    # remove empty spaces(this removes more than 1 space)
+    blank = text.str.isspace().values.astype(bool)
+
+    # convert to utf-8. Only non-ASCII values need to go through the encoder
+    non_ascii = text.str.contains(NON_ASCII_PATTERN).values.astype(bool)
+    if non_ascii.any():
+        text[non_ascii] = text[non_ascii].map(lambda x: convert_encoding(x, logger=logger))
+
+    # strip every value(this should get rid of ^M too), then quotes
+    text = text.map(_strip_value)
+
+    values = text.values
+    values[blank | (text == '__missing__value__').values.astype(bool)] = np.nan
+    cleaned[present] = values
+
+    return pd.Series(cleaned, index=column.index, name=column.name)
+
+def _strip_value(text):
+    return text.strip().strip("'").strip('"')
+
 #----------------------------------------
 # Convert a dataframe into newline-delimited JSON string
 #  -- should work for a small to medium files
@@ -105,15 +134,78 @@ def convert_df_to_njson(df, logger=None):
         logger.log_text("Converting dataframe into a new-line delimited JSON file", severity='INFO')
 
     file_to_upload = StringIO()
-
-    for _, rec in df.iterrows():
-        file_to_upload.write(rec.convert_objects(convert_numeric=False).to_json() + "\n")
-
+    write_df_as_njson(df, file_to_upload)
     file_to_upload.seek(0)
 
     return file_to_upload.getvalue()
 
 
+#----------------------------------------
+# Write a dataframe to a file-like object as newline-delimited
+# JSON, one object per row keyed by column name (nan -> null).
+# Rows are serialized a block at a time by pandas' JSON writer,
+# so no Series is built per row and the intermediate string
+# stays bounded for large frames
+#----------------------------------------
+def write_df_as_njson(df, file_obj, block_rows=NJSON_BLOCK_ROWS):
+    """Writes a dataframe as new-line delimited JSON
+    """
+    for start in xrange(0, len(df.index), block_rows):
+        block = df.iloc[start:start + block_rows].to_json(orient='records', lines=True)
+        file_obj.write(block)
+        if not block.endswith("\n"):
+            file_obj.write("\n")
+
+
+#----------------------------------------
+# Write a dataframe to a file-like object as headerless CSV.
+# BigQuery matches CSV fields to the schema by position, so the
+# columns are written in schema order. Like JSON keys, schema names
+# are matched to columns case-insensitively; a field with no column
+# is written NULL, and columns not in the schema are dropped,
+# as ignoreUnknownValues does for JSON. NULLs are written as
+# CSV_NULL_MARKER (the load job is told so), because BigQuery would
+# load an empty CSV field as NULL: this way an empty string stays an
+# empty string in STRING fields, as it does from NDJSON. Other field
+# types cannot hold an empty value, so there it is written as NULL.
+#----------------------------------------
+def write_df_as_csv(df, file_obj, schema, block_rows=NJSON_BLOCK_ROWS):
+    """Writes a dataframe as CSV in schema column order
+    """
+    lookup = dict((str(column).lower(), column) for column in df.columns)
+    columns = [lookup.get(field['name'].lower()) for field in schema]
+
+    for start in xrange(0, len(df.index), block_rows):
+        block = df.iloc[start:start + block_rows]
+        csv_block = pd.DataFrame(OrderedDict(
+            (field['name'], _csv_field_values(block, field, column))
+            for field, column in zip(schema, columns)), index=block.index)
+        # to_csv only writes to real files, so render the block and write that
+        file_obj.write(csv_block.to_csv(header=False, index=False, na_rep=CSV_NULL_MARKER))
+
+
+def _csv_field_values(block, field, column):
+    if column is None:
+        return np.nan
+    values = block[column]
+    if field.get('type', 'STRING').upper() != 'STRING':
+        values = values.replace('', np.nan)
+    return values
+
+
+#----------------------------------------
+# Write a dataframe in one of the formats we can hand to a
+# BigQuery load job
+#----------------------------------------
+def write_df_for_load(df, file_obj, source_format='NEWLINE_DELIMITED_JSON', schema=None):
+    if source_format == 'NEWLINE_DELIMITED_JSON':
+        write_df_as_njson(df, file_obj)
+    elif source_format == 'CSV':
+        write_df_as_csv(df, file_obj, schema)
+    else:
+        raise ValueError('Unsupported load format: {0}'.format(source_format))
+
+
 def remove_duplicates(df, unique_key, logger=None):
     """Removes duplicates in a dataframe based on the unique combination of key
         unique_key accepts a list
@@ -185,15 +277,24 @@ def convert_encoding(text, new_coding='UTF-8', logger=None):
     if isinstance(text, (int, float)):
         text = str(text)
 
-    if all([True if ord(i) < 128 else False for i in text]):
+    if isinstance(text, unicode):
+        return text.encode(new_coding)
+
+    # ASCII, or already in the new coding (e.g. the whole file was converted
+    # by convert_buffer_encoding, which rejects mixed-encoding files). Only
+    # values that did not come through it get past this:
+    try:
+        text.decode(new_coding)
         return text
+    except UnicodeError:
+        pass
 
     try:
         encoding = chardet.detect(text)['encoding']
         if logger:
             logger.log_text('Found {0} encoded string - {1}'.format(encoding, text), severity='DEBUG')
         if new_coding.upper() != encoding.upper():
-            text = text.decode(encoding, text).encode(new_coding)
+            text = text.decode(encoding).encode(new_coding)
             if logger:
                 logger.log_text('New {0} encoded string - {1}'.format(new_coding, text), severity='DEBUG')
         return text
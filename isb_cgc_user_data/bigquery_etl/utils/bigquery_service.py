@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Copyright 2017, Institute for Systems Biology.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cached BigQuery service objects.
+
+discovery.build fetches and parses the BigQuery API description, so we build
+the service once per credential file and reuse it. The service's http object
+is not thread safe, and files are loaded on several threads, so the cache is
+per thread. The file pools in uduprocessor are long-lived, so each of their
+threads builds its service once and then reuses it. The credentials come from
+the shared provider, which keeps the access token fresh; credentials that
+have become invalid get a newly built service.
+"""
+
+import threading
+import time
+
+from googleapiclient import discovery
+from isb_cgc_user_data.utils.credentials import get_credentials
+
+_services = threading.local()
+
+#
+# Optional timing hook, called as hook(event, seconds). event is 'build' when a
+# service is built (startup cost) and 'get' for every call (per-call cost).
+# The worker runner tallies these in its job metrics:
+#
+
+_timing_hook = None
+
+
+def set_timing_hook(hook):
+    global _timing_hook
+    _timing_hook = hook
+
+
+def _timed(event, start):
+    if _timing_hook is not None:
+        _timing_hook(event, time.time() - start)
+
+
+def get_bigquery_service(credential_path, logger=None):
+    start = time.time()
+    cache = getattr(_services, 'cache', None)
+    if cache is None:
+        cache = _services.cache = {}
+
+    cached = cache.get(credential_path)
+    if cached is not None:
+        credentials, bigquery = cached
+        if credentials.invalid:
+            cached = None
+
+    if cached is None:
+        credentials = get_credentials(credential_path)
+        bigquery = discovery.build('bigquery', 'v2', credentials=credentials)
+        cache[credential_path] = (credentials, bigquery)
+        _timed('build', start)
+        if logger:
+            logger.log_text('Built BigQuery service in {0:.2f} seconds'.format(time.time() - start), severity='INFO')
+
+    _timed('get', start)
+    return bigquery
@@ -21,12 +21,19 @@ import pandas as pd
 from isb_cgc_user_data.bigquery_etl.utils import sync_query
 
 
-def run(project_id, query):
-    """Runs a sync query and onverts the results to a dataframe
+def run(config, project_id, query):
+    """Runs a sync query and converts the results to a dataframe,
+      built from the column batches of each result page
     """
     # query a table
-    results = sync_query.main(project_id, query, timeout=1, num_retries=5)
-    data_df = pd.DataFrame(results)
+    names = None
+    batches = []
+    for names, batch in sync_query.query_column_batches(config, project_id, query, timeout=1, num_retries=5):
+        batches.append(batch)
+
+    if names is None:
+        return pd.DataFrame()
+    columns = dict((name, np.concatenate([batch[name] for batch in batches])) for name in names)
+    data_df = pd.DataFrame(columns, columns=names)
     data_df = data_df.fillna(value=np.nan)
     return data_df
-
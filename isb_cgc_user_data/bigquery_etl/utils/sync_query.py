@@ -32,8 +32,7 @@ import argparse
 import json
 import pandas as pd
 import os
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+from isb_cgc_user_data.bigquery_etl.utils.bigquery_service import get_bigquery_service
 import numpy as np
 from isb_cgc_user_data.utils import build_config
 
@@ -50,16 +49,34 @@ def sync_query(bigquery, project_id, query, timeout=10000, num_retries=5):
 
 def main(config, project_id, query, timeout, num_retries):
 
-    current_cred = os.environ['GOOGLE_APPLICATION_CREDENTIALS']
-    new_cred = config['privatekey_path']
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = new_cred
-    # Grab the application's default credentials from the environment.
-    credentials = GoogleCredentials.get_application_default()
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = current_cred
+    # The service object for interacting with the BigQuery API is cached (per thread).
+    bigquery = get_bigquery_service(config['privatekey_path'])
 
-    # Construct the service object for interacting with the BigQuery API.
-    bigquery = discovery.build('bigquery', 'v2', credentials=credentials)
+    query_job = sync_query(
+        bigquery,
+        project_id,
+        query,
+        timeout,
+        num_retries)
+
+    # Page through the result set and collect all results.
+    results = []
+    print ('Paging through the results..')
+    for page in iter_result_pages(bigquery, query_job):
+        results.extend(process_results(page))
+
+    return results
+
+
+#
+# Generator version of main: runs the query and yields the results one page at a time, as
+# a list of column names and a dict of name -> NumPy array. Only one page of rows is held
+# at a time, and the per-row work is a single pass over the cells:
+#
 
+def query_column_batches(config, project_id, query, timeout=10000, num_retries=5):
+
+    bigquery = get_bigquery_service(config['privatekey_path'])
     query_job = sync_query(
         bigquery,
         project_id,
@@ -67,35 +84,55 @@ def main(config, project_id, query, timeout, num_retries):
         timeout,
         num_retries)
 
-    # Page through the result set and print all results.
-    results = list()
+    for page in iter_result_pages(bigquery, query_job):
+        yield page_column_batch(page)
+
+
+def iter_result_pages(bigquery, query_job, num_retries=2):
     page_token = None
-    print ('Paging through the results..')
     while True:
         page = bigquery.jobs().getQueryResults(
             pageToken=page_token,
-            **query_job['jobReference']).execute(num_retries=2)
-
-        page_results = process_results(page)
-        results = results + page_results
+            **query_job['jobReference']).execute(num_retries=num_retries)
+        yield page
         page_token = page.get('pageToken')
         if not page_token:
             break
 
-    return results
+
+def page_column_batch(page):
+    fields = page['schema']['fields']
+    names = [field['name'] for field in fields]
+    rows = page.get('rows', [])
+    if rows:
+        columns = zip(*[[cell['v'] for cell in row['f']] for row in rows])
+    else:
+        columns = [()] * len(fields)
+    batch = {}
+    for field, column in zip(fields, columns):
+        batch[field['name']] = typed_column(field['type'], column)
+    return names, batch
+
+
+#
+# BigQuery sends every value as a string (or None). Numeric and boolean columns are
+# converted; integer columns holding NULLs become float so they can hold NaN:
+#
+
+def typed_column(bq_type, values):
+    if bq_type in ('INTEGER', 'INT64') and None not in values:
+        return np.array([int(value) for value in values], dtype=np.int64)
+    if bq_type in ('INTEGER', 'INT64', 'FLOAT', 'FLOAT64'):
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    if bq_type in ('BOOLEAN', 'BOOL'):
+        return np.array([None if value is None else value == 'true' for value in values], dtype=object)
+    return np.array(values, dtype=object)
+
 
 def process_results(results):
     fields = results['schema']['fields']
-    rows = results['rows']
-    results = []
-    for row in rows:
-        row_results = {}
-        for i in xrange(0, len(fields)):
-            cell = row['f'][i]
-            field = fields[i]
-            row_results[field['name']] = cell['v']
-        results.append(row_results)
-    return results
+    names = [field['name'] for field in fields]
+    return [dict(zip(names, [cell['v'] for cell in row['f']])) for row in results.get('rows', [])]
 
 
 if __name__ == '__main__':
@@ -16,18 +16,28 @@
 import argparse
 import json
 import requests
+import threading
+import time
 import traceback
 import os
 import urllib
+import uuid
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import user_gen.user_gen_processing
 import user_gen.molecular_processing
 import user_gen.low_level_processing
 import user_gen.vcf_processing
 from not_psq.safe_logger import Safe_Logger
+from isb_cgc_user_data.bigquery_etl.extract.gcloud_wrapper import GcsConnector
+from isb_cgc_user_data.bigquery_etl.load import load_data_from_file
 from isb_cgc_user_data.utils.build_config import read_dict
 from isb_cgc_user_data.utils.processed_file import processed_name
 from isb_cgc_user_data.utils.error_handling import UduException
+from isb_cgc_user_data.utils.job_claims import JobClaim
+from user_gen.metadata_updates import MetadataWriter
 
 #
 # Here we read the config and secret file
@@ -51,33 +61,206 @@ def generate_bq_schema(columns):
     return obj
 
 
-def process_upload(user_data_config, success_url, failure_url):
+def file_metadata(file, user_study):
+    inputfilename = file['FILENAME']
+    metadata = {
+        'sample_barcode': file.get('SAMPLEBARCODE', ''),
+        'case_barcode': file.get('CASEBARCODE', ''),
+        'project_id': user_study,
+        'platform': file.get('PLATFORM', ''),
+        'pipeline': file.get('PIPELINE', ''),
+    }
+
+    # Update metadata_data table in cloudSQL
+    metadata['file_path'] = inputfilename
+    metadata['file_name'] = inputfilename.split('/')[-1]
+    metadata['data_type'] = file['DATATYPE']
+    return metadata
+
+
+def process_molecular_file(project_id, bq_dataset, user_study, cloudsql_tables, file, config, writer, loads):
+    inputfilename = file['FILENAME']
+    blob_name = inputfilename.split('/')[1:] # Path without bucket. Assuming bucket name appended to front of file path.
+    logger.log_text('uduprocessor: Processing molecular {0}'.format(blob_name), severity='INFO')
+    # Files run side by side, so make the staged file name unique:
+    outputfilename = '{0}.{1}.out'.format(inputfilename.split('/')[-1], uuid.uuid4().hex) # Get the actual file name
+    bucket_name = inputfilename.split('/')[0] # Get the bucketname
+
+    # Transform and load metadata
+    user_gen.molecular_processing.parse_file(project_id,
+                                             bq_dataset,
+                                             bucket_name,
+                                             file,
+                                             blob_name,
+                                             outputfilename,
+                                             file_metadata(file, user_study),
+                                             cloudsql_tables,
+                                             config,
+                                             logger,
+                                             writer=writer,
+                                             loads=loads
+                                            )
+    logger.log_text('uduprocessor: Processed molecular {0}'.format(blob_name), severity='INFO')
+
+
+def process_low_level_file(project_id, bq_dataset, user_study, cloudsql_tables, file, config, writer):
+    inputfilename = file['FILENAME']
+    blob_name = inputfilename.split('/')[1:]  # Path without bucket. Assuming bucket name appended to front of file path.
+    logger.log_text('uduprocessor: Processing low-level {0}'.format(blob_name), severity='INFO')
+    outputfilename = '{0}.out'.format(inputfilename.split('/')[-1])  # Get the actual file name
+    bucket_name = inputfilename.split('/')[0]  # Get the bucketname
+
+    # Transform and load metadata
+    user_gen.low_level_processing.parse_file(project_id,
+                                             bq_dataset,
+                                             bucket_name,
+                                             file,
+                                             blob_name,
+                                             outputfilename,
+                                             file_metadata(file, user_study),
+                                             cloudsql_tables,
+                                             config,
+                                             logger,
+                                             writer=writer
+                                            )
+    logger.log_text('uduprocessor: Processed low-level {0}'.format(blob_name), severity='INFO')
+
+
+#
+# Runs (name, function) tasks on at most `workers` threads. Every task is run to the end, then
+# all the failures are reported together, in task order. A single failure is re-raised as is, so
+# the user sees the same message as before; several are combined into one UduException, which
+# counts them as `what` (e.g. files, or table loads).
+#
+# The pools are long-lived, one per calling thread (i.e. per worker job thread), so their threads
+# last as long as the worker does. The storage clients and BigQuery services, which are cached per
+# thread, are then reused from job to job instead of being rebuilt for every upload:
+#
+
+FILE_WORKERS = 4
+_file_pools = threading.local()
+
+
+def get_file_pool(workers):
+    pools = getattr(_file_pools, 'pools', None)
+    if pools is None:
+        pools = _file_pools.pools = {}
+    pool = pools.get(workers)
+    if pool is None:
+        pool = pools[workers] = ThreadPool(workers)
+    return pool
+
+
+def run_file_tasks(tasks, workers, what='files'):
+    def run_task(task):
+        name, func = task
+        try:
+            func()
+            return None
+        except Exception as exp:
+            logger.log_text('uduprocessor: {0} failed: {1}'.format(name, traceback.format_exc()), severity='ERROR')
+            return name, exp
+
+    pool = get_file_pool(max(1, workers))
+    failures = [failure for failure in pool.map(run_task, tasks, chunksize=1) if failure is not None]
+
+    if len(failures) == 1:
+        raise failures[0][1]
+    if failures:
+        messages = []
+        for name, exp in failures:
+            message = exp.message if isinstance(exp, UduException) else 'Unexpected error loading data'
+            messages.append('{0}: {1}'.format(name.split('/')[-1], message))
+        raise UduException('{0} {1} failed. {2}'.format(len(failures), what, ' '.join(messages)))
+
+
+#
+# The molecular files are staged first and then loaded with one BigQuery job per destination
+# table, listing all of the table's staged files as sourceUris:
+#
+
+def load_staged_files(project_id, bq_dataset, staged_loads, config):
+    tables = OrderedDict()
+    for staged in staged_loads:
+        tables.setdefault((staged['table_name'], staged['source_format']), []).append(staged)
+
+    load_tasks = []
+    for (table_name, source_format), group in tables.items():
+        logger.log_text('uduprocessor: Loading {0} staged files into {1}'.format(len(group), table_name), severity='INFO')
+        load_tasks.append((table_name, partial(load_data_from_file.run,
+                                               config,
+                                               project_id,
+                                               bq_dataset,
+                                               table_name,
+                                               group[0]['schema'],
+                                               [staged['source_path'] for staged in group],
+                                               source_format=source_format,
+                                               write_disposition='WRITE_APPEND',
+                                               is_schema_file=False,
+                                               logger=logger)))
+    run_file_tasks(load_tasks, int(config.get('UDU_FILE_WORKERS', FILE_WORKERS)), what='table loads')
+
+
+#
+# Runs in a finally clause, so failures here are only logged: they must not replace the
+# exception that failed the job. A staged file that is left behind is just clutter in tmp_bucket:
+#
+
+def delete_staged_files(project_id, staged_loads, config):
+    if not staged_loads:
+        return
     try:
-        #
-        # OK, Pub/Sub does NOT guarantee that a message gets delivered ONLY once. It may come in > 1 time.
-        # It might also be possible that the WebApp sends us the same job request twice, though this should
-        # never happen.
-        # So we need to flag the job is being/has been handled. Right now, with ony one worker handling
-        # requests, we can get away with moving the config file to a new location. Once we set up multiple
-        # workers, the operation will need to be more atomic (e.g. an atomic database entry).
-        #
-
-        processed = processed_name(user_data_config)
-        have_processed = os.path.isfile(processed)
-        have_pending = os.path.isfile(user_data_config)
-
-        if have_processed:
-            if have_pending:
-                logger.log_text('uduprocessor unexpected duplicate request from web app ignored {0}'.format(user_data_config),
-                                severity='ERROR')
-            else:
-                logger.log_text('uduprocessor duplicate pubsub message ignored {0}'.format(user_data_config),
-                                severity='WARNING')
-            return
+        gcs = GcsConnector(project_id, config['tmp_bucket'], config, logger=logger)
+    except Exception:
+        logger.log_text('uduprocessor: Could not delete temporary files: {0}'.format(traceback.format_exc()),
+                        severity='WARNING')
+        return
+    for staged in staged_loads:
+        try:
+            gcs.delete_blob(staged['blob_name'])
+            logger.log_text('uduprocessor: Deleted temporary file {0}'.format(staged['blob_name']), severity='INFO')
+        except Exception:
+            logger.log_text('uduprocessor: Could not delete temporary file {0}: {1}'.format(
+                staged['blob_name'], traceback.format_exc()), severity='WARNING')
+
+
+def process_upload(user_data_config, success_url, failure_url, message_id=None, submitted_at=None):
+    #
+    # OK, Pub/Sub does NOT guarantee that a message gets delivered ONLY once. It may come in > 1 time.
+    # It might also be possible that the WebApp sends us the same job request twice, though this should
+    # never happen. And there are several workers, maybe on several hosts.
+    # So we atomically claim the job in the job claim table before touching it. A job whose worker
+    # died mid-way gets claimed again when Pub/Sub redelivers it.
+    # For a duplicate, returns the state the claim was found in ('running', 'done' or 'failed'),
+    # so the caller can keep the task of a job still running elsewhere. Returns None otherwise.
+    # This is done outside the try below: an error reaching the claim table says nothing about the
+    # job, which may be running or done elsewhere, so it is raised to the caller (which puts the task
+    # back for another try) instead of being reported to the WebApp as a failure.
+    #
+
+    processed = processed_name(user_data_config)
+    have_pending = os.path.isfile(user_data_config)
+
+    claim = JobClaim(my_config, user_data_config, message_id)
+    if not claim.claim():
+        state = claim.current()
+        if have_pending:
+            logger.log_text('uduprocessor unexpected duplicate request from web app ignored {0}'.format(user_data_config),
+                            severity='ERROR')
+        else:
+            logger.log_text('uduprocessor duplicate pubsub message ignored {0} (state {1}, attempts {2})'.format(
+                            user_data_config, state[0] if state else None, state[1] if state else None),
+                            severity='WARNING')
+        return state[0] if state else None
 
+    try:
         logger.log_text('uduprocessor handling request', severity='INFO')
-        # Move the processed file:
-        os.rename(user_data_config, processed)
+        if submitted_at:
+            logger.log_text('uduprocessor: submit-to-start {0:.1f} seconds for {1}'.format(
+                            time.time() - submitted_at, user_data_config), severity='INFO')
+        # Move the processed file (a retried job finds it already moved):
+        if have_pending:
+            os.rename(user_data_config, processed)
         # This construct closes the file ASAP:
         with open(processed, 'r') as f:
             configs = f.read()
@@ -97,6 +280,18 @@ def process_upload(user_data_config, success_url, failure_url):
             'FEATURE_DEFS': data['USER_METADATA_TABLES']['FEATURE_DEFS']
         }
 
+        # A job may ask for a different BigQuery staging format (NEWLINE_DELIMITED_JSON or CSV)
+        # than the server default:
+        job_config = my_config.copy()
+        if 'BQ_LOAD_FORMAT' in data:
+            job_config['UDU_BQ_LOAD_FORMAT'] = data['BQ_LOAD_FORMAT']
+        if job_config.get('UDU_BQ_LOAD_FORMAT', 'NEWLINE_DELIMITED_JSON') not in ('NEWLINE_DELIMITED_JSON', 'CSV'):
+            raise UduException('Unsupported BigQuery load format: {0}'.format(job_config['UDU_BQ_LOAD_FORMAT']))
+
+        # All the CloudSQL metadata for the job is collected here and written in one transaction once
+        # every file has been loaded, so a failed job leaves no partial metadata behind:
+        metadata_writer = MetadataWriter(job_config, logger=logger)
+
         # Check for user_gen files and process them first
         user_gen_list = []
         mol_file_list = []
@@ -140,8 +335,9 @@ def process_upload(user_data_config, success_url, failure_url):
                                                                 bq_dataset,
                                                                 cloudsql_tables,
                                                                 user_gen_list,
-                                                                my_config,
-                                                                logger)
+                                                                job_config,
+                                                                logger,
+                                                                writer=metadata_writer)
             logger.log_text('uduprocessor: Processed user_gen', severity='INFO')
 
         # Process all VCF Files. NOTE: process_vcf_files is currently an unimplemented stub!
@@ -154,89 +350,44 @@ def process_upload(user_data_config, success_url, failure_url):
                                                       bq_dataset,
                                                       cloudsql_tables,
                                                       vcf_file_list,
-                                                      my_config,
+                                                      job_config,
                                                       logger)
             logger.log_text('uduprocessor: Processed vcf', severity='INFO')
 
-        # Process all other datatype files
-        if len(mol_file_list):
-            logger.log_text('uduprocessor: Processing molecular', severity='INFO')
-            for file in mol_file_list:
-                table_name = file['BIGQUERY_TABLE_NAME']
-                inputfilename = file['FILENAME']
-
-                blob_name = inputfilename.split('/')[1:] # Path without bucket. Assuming bucket name appended to front of file path.
-                logger.log_text('uduprocessor: Processing molecular {0}'.format(blob_name), severity='INFO')
-                outputfilename = '{0}.out'.format(inputfilename.split('/')[-1]) # Get the actual file name
-                bucket_name = inputfilename.split('/')[0] # Get the bucketname
-
-                metadata = {
-                    'sample_barcode': file.get('SAMPLEBARCODE', ''),
-                    'case_barcode': file.get('CASEBARCODE', ''),
-                    'project_id': user_study,
-                    'platform': file.get('PLATFORM', ''),
-                    'pipeline': file.get('PIPELINE', ''),
-                }
-
-                # Update metadata_data table in cloudSQL
-                metadata['file_path'] = inputfilename
-                metadata['file_name'] = inputfilename.split('/')[-1]
-                metadata['data_type'] = file['DATATYPE']
-
-                # Transform and load metadata
-                user_gen.molecular_processing.parse_file(project_id,
-                                                         bq_dataset,
-                                                         bucket_name,
-                                                         file,
-                                                         blob_name,
-                                                         outputfilename,
-                                                         metadata,
-                                                         cloudsql_tables,
-                                                         my_config,
-                                                         logger
-                                                        )
-                logger.log_text('uduprocessor: Processed molecular {0}'.format(blob_name), severity='INFO')
-            logger.log_text('uduprocessor: Processed molecular', severity='INFO')
-
-        if len(low_level_list):
-            logger.log_text('uduprocessor: Processing low-level', severity='INFO')
-            for file in low_level_list:
-                table_name = file['BIGQUERY_TABLE_NAME']
-
-                inputfilename = file['FILENAME']
-                blob_name = inputfilename.split('/')[
-                            1:]  # Path without bucket. Assuming bucket name appended to front of file path.
-                logger.log_text('uduprocessor: Processing low-level {0}'.format(blob_name), severity='INFO')
-                outputfilename = '{0}.out'.format(inputfilename.split('/')[-1])  # Get the actual file name
-                bucket_name = inputfilename.split('/')[0]  # Get the bucketname
-
-                metadata = {
-                    'sample_barcode': file.get('SAMPLEBARCODE', ''),
-                    'case_barcode': file.get('CASEBARCODE', ''),
-                    'project_id': user_study,
-                    'platform': file.get('PLATFORM', ''),
-                    'pipeline': file.get('PIPELINE', ''),
-                }
-
-                # Update metadata_data table in cloudSQL
-                metadata['file_path'] = inputfilename
-                metadata['file_name'] = inputfilename.split('/')[-1]
-                metadata['data_type'] = file['DATATYPE']
-
-                # Transform and load metadata
-                user_gen.low_level_processing.parse_file(project_id,
-                                                         bq_dataset,
-                                                         bucket_name,
-                                                         file,
-                                                         blob_name,
-                                                         outputfilename,
-                                                         metadata,
-                                                         cloudsql_tables,
-                                                         my_config,
-                                                         logger
-                                                        )
-                logger.log_text('uduprocessor: Processed low-level {0}'.format(blob_name), severity='INFO')
-            logger.log_text('uduprocessor: Processed low-level', severity='INFO')
+        # Process all other datatype files. The files are independent of each other, so they are
+        # run on a small thread pool (most of the time goes to downloads, uploads and BigQuery
+        # load polling). Each file queues its metadata on its own writer; these are merged back in
+        # file order, so the metadata is written in the same order as when running one at a time.
+        # The molecular files are only staged here; loading happens once they are all staged:
+        file_tasks = []
+        file_writers = []
+        file_loads = []
+        for file in mol_file_list:
+            file_writer = MetadataWriter(job_config, logger=logger)
+            file_writers.append(file_writer)
+            loads = []
+            file_loads.append(loads)
+            file_tasks.append((file['FILENAME'], partial(process_molecular_file, project_id, bq_dataset, user_study,
+                                                         cloudsql_tables, file, job_config, file_writer, loads)))
+        for file in low_level_list:
+            file_writer = MetadataWriter(job_config, logger=logger)
+            file_writers.append(file_writer)
+            file_tasks.append((file['FILENAME'], partial(process_low_level_file, project_id, bq_dataset, user_study,
+                                                         cloudsql_tables, file, job_config, file_writer)))
+
+        if len(file_tasks):
+            logger.log_text('uduprocessor: Processing molecular and low-level', severity='INFO')
+            try:
+                run_file_tasks(file_tasks, int(job_config.get('UDU_FILE_WORKERS', FILE_WORKERS)))
+                load_staged_files(project_id, bq_dataset, [load for loads in file_loads for load in loads], job_config)
+            finally:
+                delete_staged_files(project_id, [load for loads in file_loads for load in loads], job_config)
+            for file_writer in file_writers:
+                metadata_writer.merge(file_writer)
+            logger.log_text('uduprocessor: Processed molecular and low-level', severity='INFO')
+
+        logger.log_text('uduprocessor: Writing metadata', severity='INFO')
+        metadata_writer.flush()
         callback_url = success_url;
         job_status = 'success'
         log_severity = 'INFO'
@@ -254,6 +405,11 @@ def process_upload(user_data_config, success_url, failure_url):
         ready_msg = urllib.quote('Unexpected error loading data')
         callback_url = '{0}&errmsg={1}'.format(failure_url, ready_msg);
 
+    try:
+        claim.finish('done' if job_status == 'success' else 'failed')
+    except Exception:
+        logger.log_text(traceback.format_exc(), severity='ERROR')
+
     # Let the WebApp know what happened to the job.
     logger.log_text('uduprocessor registering {0} to {1}'.format(job_status, callback_url), severity=log_severity)
     r = requests.get(callback_url)
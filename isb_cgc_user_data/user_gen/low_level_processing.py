@@ -21,14 +21,14 @@ import sys
 from metadata_updates import update_metadata_data_list
 
 
-def parse_file(project_id, bq_dataset, bucket_name, file_data, filename, outfilename, metadata, cloudsql_tables, config, logger):
+def parse_file(project_id, bq_dataset, bucket_name, file_data, filename, outfilename, metadata, cloudsql_tables, config, logger, writer=None):
     logger.log_text('uduprocessor: Begin low-level processing {0}'.format(filename), severity='INFO')
     sample_metadata_list = []
     new_metadata = metadata.copy()
     new_metadata['sample_barcode'] = 'low_level_data_barcode'
     new_metadata['file_path'] = file_data['FILENAME']
     sample_metadata_list.append(new_metadata)
-    update_metadata_data_list(config, cloudsql_tables['METADATA_DATA'], sample_metadata_list)
+    update_metadata_data_list(config, cloudsql_tables['METADATA_DATA'], sample_metadata_list, writer=writer)
 
 def get_column_mapping(columns):
     column_map = {}
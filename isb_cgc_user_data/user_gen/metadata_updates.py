@@ -11,11 +11,131 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+
 import MySQLdb
 import pandas as pd
 
 from cloudsql_table_schemas import user_metadata
-from isb_cgc_user_data.utils.sql_connector import cloudsql_connector
+from isb_cgc_user_data.utils.sql_connector import cloudsql_connection
+
+#
+# The metadata writes for a job are collected by a MetadataWriter and flushed together, in one
+# transaction, once the job's data is loaded. Inserts are sent as multi-row
+# INSERT ... VALUES (...),(...) statements of at most batch_rows rows. If anything fails, the
+# transaction is rolled back and none of the job's metadata is written. Consecutive inserts into
+# the same table and columns are merged, so the per-file writes of a job turn into a few batches.
+#
+# Very large plain inserts (e.g. the metadata_samples rows of a big user_gen upload) can instead be
+# streamed with LOAD DATA LOCAL INFILE: set UDU_SQL_LOAD_DATA_ROWS to the row count at which to switch.
+# 0 (the default) always uses INSERT.
+#
+# The functions below take an optional writer. Without one they write (and commit) immediately.
+#
+
+INSERT_BATCH_ROWS = 1000
+LOAD_DATA_ROWS = 0
+
+
+class MetadataWriter(object):
+    def __init__(self, config, batch_rows=None, logger=None):
+        self.config = config
+        self.batch_rows = batch_rows or int(config.get('UDU_SQL_BATCH_ROWS', INSERT_BATCH_ROWS))
+        self.load_data_rows = int(config.get('UDU_SQL_LOAD_DATA_ROWS', LOAD_DATA_ROWS))
+        self.logger = logger
+        self._operations = []
+
+    def insert(self, table, columns, rows, on_duplicate=None):
+        key = ('insert', table, tuple(columns), on_duplicate)
+        if self._operations and self._operations[-1][0] == key:
+            self._operations[-1][1].extend(rows)
+        else:
+            self._operations.append((key, list(rows)))
+
+    def execute(self, statement):
+        self._operations.append((('execute', statement), None))
+
+    # Appends the operations queued on another writer (e.g. one per file) after ours
+    def merge(self, other):
+        for key, rows in other._operations:
+            if key[0] == 'execute':
+                self._operations.append((key, None))
+            else:
+                self.insert(key[1], key[2], rows, on_duplicate=key[3])
+
+    def pending(self):
+        return len(self._operations)
+
+    def flush(self):
+        if not self._operations:
+            return
+        operations, self._operations = self._operations, []
+        statements = 0
+        with cloudsql_connection(self.config) as db:
+            cursor = db.cursor()
+            for key, rows in operations:
+                if key[0] == 'execute':
+                    cursor.execute(key[1])
+                    statements += 1
+                    continue
+                _, table, columns, on_duplicate = key
+                if on_duplicate is None and 0 < self.load_data_rows <= len(rows):
+                    _load_data_infile(cursor, table, columns, rows)
+                    statements += 1
+                    continue
+                for start in xrange(0, len(rows), self.batch_rows):
+                    batch = rows[start:start + self.batch_rows]
+                    cursor.execute(_multi_row_insert(table, columns, len(batch), on_duplicate),
+                                   [value for row in batch for value in row])
+                    statements += 1
+            db.commit()
+            cursor.close()
+        if self.logger:
+            self.logger.log_text('uduprocessor: Wrote metadata in one transaction ({0} statements)'.format(statements),
+                                 severity='INFO')
+
+
+def _multi_row_insert(table, columns, row_count, on_duplicate=None):
+    row = '({0})'.format(','.join(['%s'] * len(columns)))
+    stmt = 'INSERT INTO {0} ({1}) VALUES {2}'.format(table, ','.join(columns), ','.join([row] * row_count))
+    if on_duplicate:
+        stmt += ' ON DUPLICATE KEY UPDATE {0}'.format(on_duplicate)
+    return stmt
+
+
+def _load_data_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, bool):
+        value = str(int(value))
+    elif isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def _load_data_infile(cursor, table, columns, rows):
+    # The connection must have been opened with local_infile (see cloudsql_connector)
+    with tempfile.NamedTemporaryFile(suffix='.tsv') as tsv:
+        for row in rows:
+            tsv.write('\t'.join([_load_data_value(value) for value in row]))
+            tsv.write('\n')
+        tsv.flush()
+        cursor.execute("LOAD DATA LOCAL INFILE %s INTO TABLE {0} CHARACTER SET utf8 "
+                       "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({1})".format(table, ','.join(columns)),
+                       (tsv.name,))
+
+
+def _write(config, writer, queue):
+    if writer is not None:
+        queue(writer)
+        return
+    writer = MetadataWriter(config)
+    queue(writer)
+    writer.flush()
 
 
 def cloudsql_append_column(config, table, missing_column_names, all_columns, inputfilename):
@@ -33,15 +153,14 @@ def cloudsql_append_column(config, table, missing_column_names, all_columns, inp
 
     alter_stmt += ');'
     # print alter_stmt
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute(alter_stmt)
-    db.commit()
+    with cloudsql_connection(config) as db:
+        cursor = db.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute(alter_stmt)
+        db.commit()
 
-    # TODO: add data from inputfile
+        # TODO: add data from inputfile
 
-    cursor.close()
-    db.close()
+        cursor.close()
 
 
 '''
@@ -49,18 +168,17 @@ Function to check if the given columns are the same as the table we're trying to
 Returns list of columns that are not in the the table.
 '''
 def check_update_metadata_samples(config, table, columns):
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute('describe {0};'.format(table))
-    column_names = [d['NAME'] for d in columns]
-
-    # For each column in the table, remove it from the list of given column names
-    for row in cursor.fetchall():
-        if row['Field'] in column_names:
-            column_names.remove(row['Field'])
-
-    cursor.close()
-    db.close()
+    with cloudsql_connection(config) as db:
+        cursor = db.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute('describe {0};'.format(table))
+        column_names = [d['NAME'] for d in columns]
+
+        # For each column in the table, remove it from the list of given column names
+        for row in cursor.fetchall():
+            if row['Field'] in column_names:
+                column_names.remove(row['Field'])
+
+        cursor.close()
     return column_names
 
 
@@ -82,21 +200,19 @@ def update_metadata_data(config, table, metadata):
     # print insert_stmt
     # print value_list
 
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute(insert_stmt)
-    db.commit()
-    cursor.close()
-    db.close()
+    with cloudsql_connection(config) as db:
+        cursor = db.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute(insert_stmt)
+        db.commit()
+        cursor.close()
 
 '''
 Function to append data to a given metadata_data table.
 Takes in a list of metadata objects
 '''
-def update_metadata_data_list(config, table, metadata):
+def update_metadata_data_list(config, table, metadata, writer=None):
     metadata_schema = user_metadata()
     column_titles = [d['column_name'] for d in metadata_schema]
-    insert_stmt = 'INSERT INTO {0} ({1}) VALUES ({2});'.format(table, ','.join(column_titles), ','.join(['%s' for i in range(0,len(column_titles))]))
     value_list = []
 
     # Generate a tuple for each row in the metadata. Only collect data from columns in the table
@@ -108,67 +224,43 @@ def update_metadata_data_list(config, table, metadata):
             else:
                 value_tuple += ((row[title]),)
         value_list.append(value_tuple)
-    print insert_stmt
+    print 'INSERT INTO {0} ({1})'.format(table, ','.join(column_titles))
     if len(value_list) > 0:
         print value_list[0]
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.executemany(insert_stmt, value_list)
-    db.commit()
-    cursor.close()
-    db.close()
+    _write(config, writer, lambda w: w.insert(table, column_titles, value_list))
 
 '''
 Function to insert all metadata_samples data at once from user_gen datatype
 '''
-def insert_metadata_samples(config, data_df, table):
-    columns = data_df.columns.values
-    data_df = data_df.where((pd.notnull(data_df)), None)
-    insert_stmt = 'INSERT INTO {0} ({1}) VALUES({2})'.format(table,
-                                                             ','.join(columns),
-                                                             ','.join(['%s' for i in range(0, len(columns))]))
-    print insert_stmt
-    value_list = []
-    for i, j in data_df.transpose().iteritems():
-        row = data_df[i:i+1]
-        value_list.append(tuple(row.values[0]))
+def insert_metadata_samples(config, data_df, table, writer=None):
+    columns = list(data_df.columns.values)
+    # Go through object dtype so that NaN in numeric columns also becomes None
+    data_df = data_df.astype(object).where(pd.notnull(data_df), None)
+    print 'INSERT INTO {0} ({1})'.format(table, ','.join(columns))
+    value_list = [tuple(row) for row in data_df.values.tolist()]
 
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.executemany(insert_stmt, value_list)
-    db.commit()
-    cursor.close()
-    db.close()
+    _write(config, writer, lambda w: w.insert(table, columns, value_list))
 
 '''
 Function to update rows in metadata_samples with has_datatype information.
 Create new row if doesn't exist.
 '''
-def update_molecular_metadata_samples_list(config, table, datatype, sample_barcodes):
-    insert_stmt = 'INSERT INTO {0} (sample_barcode, has_{1}) VALUES (%s, %s) ON DUPLICATE KEY UPDATE has_{2}=1;'.format(table, datatype, datatype)
+def update_molecular_metadata_samples_list(config, table, datatype, sample_barcodes, writer=None):
+    columns = ['sample_barcode', 'has_{0}'.format(datatype)]
+    on_duplicate = 'has_{0}=1'.format(datatype)
     value_list = []
     for barcode in sample_barcodes:
         value_list.append((barcode, 1))
-    print insert_stmt
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.executemany(insert_stmt, value_list)
-    db.commit()
-    cursor.close()
-    db.close()
+    print 'INSERT INTO {0} ({1}) ON DUPLICATE KEY UPDATE {2}'.format(table, ','.join(columns), on_duplicate)
+    _write(config, writer, lambda w: w.insert(table, columns, value_list, on_duplicate=on_duplicate))
 
 '''
 Function to update empty case barcode values
 '''
-def update_metadata_cases(config, table):
+def update_metadata_cases(config, table, writer=None):
     update_stmt = 'UPDATE {0} set case_barcode=CONCAT("cgc_", sample_barcode) where case_barcode is NULL;'.format(table)
     print update_stmt
-    db = cloudsql_connector(config)
-    cursor = db.cursor()
-    cursor.execute(update_stmt)
-    db.commit()
-    cursor.close()
-    db.close()
+    _write(config, writer, lambda w: w.execute(update_stmt))
 
 
 '''
@@ -176,22 +268,16 @@ Function to insert one new feature definition
 '''
 def insert_feature_defs(config, sql_table, project_id, name, bq_mapping, shared_map_id, type):
     insert_stmt = 'INSERT INTO {0} (project_id, feature_name, bq_map_id, shared_map_id, is_numeric) VALUES (%s,%s,%s,%s,%s);'
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.executemany(insert_stmt, (project_id, name, bq_mapping, shared_map_id, type))
-    db.commit()
-    cursor.close()
-    db.close()
+    with cloudsql_connection(config) as db:
+        cursor = db.cursor(MySQLdb.cursors.DictCursor)
+        cursor.executemany(insert_stmt, (project_id, name, bq_mapping, shared_map_id, type))
+        db.commit()
+        cursor.close()
 
 '''
 Function to insert list of new feature definitions
 '''
-def insert_feature_defs_list(config, sql_table, data_list):
-    insert_stmt = 'INSERT INTO {0} (project_id, feature_name, bq_map_id, shared_map_id, is_numeric) VALUES (%s,%s,%s,%s,%s);'.format(sql_table)
-    print insert_stmt
-    db = cloudsql_connector(config)
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    cursor.executemany(insert_stmt, data_list)
-    db.commit()
-    cursor.close()
-    db.close()
\ No newline at end of file
+def insert_feature_defs_list(config, sql_table, data_list, writer=None):
+    columns = ['project_id', 'feature_name', 'bq_map_id', 'shared_map_id', 'is_numeric']
+    print 'INSERT INTO {0} ({1})'.format(sql_table, ','.join(columns))
+    _write(config, writer, lambda w: w.insert(sql_table, columns, data_list))
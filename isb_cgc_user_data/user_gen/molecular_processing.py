@@ -19,19 +19,21 @@
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 from isb_cgc_user_data.bigquery_etl.extract.gcloud_wrapper import GcsConnector
-from isb_cgc_user_data.bigquery_etl.extract.utils import convert_file_to_dataframe
+from isb_cgc_user_data.bigquery_etl.extract.utils import convert_file_to_dataframe, convert_file_to_dataframe_chunks, convert_buffer_encoding
 from isb_cgc_user_data.bigquery_etl.load import load_data_from_file
-from isb_cgc_user_data.bigquery_etl.transform.tools import cleanup_dataframe
+from isb_cgc_user_data.bigquery_etl.transform.tools import cleanup_dataframe, write_df_for_load
 
 from bigquery_table_schemas import get_molecular_schema
 from metadata_updates import update_metadata_data_list, update_molecular_metadata_samples_list, insert_feature_defs_list, update_metadata_cases
 from isb_cgc_user_data.utils.error_handling import UduException
-from isb_cgc_user_data.utils.check_dataframe_dups import reject_row_duplicate_or_blank, reject_dup_col_pre_dataframe, find_key_column
+from isb_cgc_user_data.utils.build_config import config_flag
+from isb_cgc_user_data.utils.check_dataframe_dups import reject_row_duplicate_or_blank, sniff_header, find_key_column
 
 def parse_file(project_id, bq_dataset, bucket_name, file_data, filename,
-               outfilename, metadata, cloudsql_tables, config, logger=None):
+               outfilename, metadata, cloudsql_tables, config, logger=None, writer=None, loads=None):
     if logger:
         logger.log_text('uduprocessor: Begin molecular processing {0}'.format(filename), severity='INFO')
 
@@ -47,98 +49,117 @@ def parse_file(project_id, bq_dataset, bucket_name, file_data, filename,
     if logger:
         logger.log_text('uduprocessor: download_blob_to_file success', severity='INFO')
 
-    # Pandas just appends _n to duplicate header keys if data in column is different (i.e. not
-    # a duplicate column. Nope! We flag it as an error:
+    # Detect the file's encoding once, up front, instead of value by value:
+    filebuffer = convert_buffer_encoding(filebuffer, logger=logger)
 
-    reject_dup_col_pre_dataframe(filebuffer, logger, 'barcode')
+    # Pandas just appends _n to duplicate header keys if data in column is different (i.e. not
+    # a duplicate column. Nope! We flag it as an error. The header is checked here, and the
+    # parser then reads the file with these column names:
 
-    # convert blob into dataframe. We may get a parsing exception out of this if e.g. a
-    # row has too many fields:
-    data_df = convert_file_to_dataframe(filebuffer, skiprows=0, header=0, logger=logger)
-    if logger:
-        logger.log_text('uduprocessor: convert_file_to_dataframe success', severity='INFO')
+    header_columns, sep, header_line = sniff_header(filebuffer, logger, 'barcode')
 
     # Get basic column information depending on datatype
     column_map = get_column_mapping(metadata['data_type'])
 
-    # Reject duplicate and blank features. Do before cleanup, because blanks
-    # will be converted to NANs:
-
-    id_col = find_key_column(data_df, column_map, logger, 'ID')
-    reject_row_duplicate_or_blank(data_df, logger, 'feature', id_col)
-
-    # clean-up dataframe. We can get a parsing exception out of this if the table has
-    # only a header, and no rows of data:
-    data_df = cleanup_dataframe(data_df, logger=logger)
-    if logger:
-        logger.log_text('uduprocessor: cleanup_dataframe success', severity='INFO')
-    new_df_data = []
+    # The staged file for the BigQuery load can be NDJSON or CSV, optionally gzipped:
+    source_format = config.get('UDU_BQ_LOAD_FORMAT', 'NEWLINE_DELIMITED_JSON')
+    compress = config_flag(config, 'UDU_STAGING_GZIP')
+    schema = get_molecular_schema()
 
-    map_values = {}
+    # Large files can be processed a chunk of rows at a time, so that the whole matrix
+    # and its long-format version are never in memory at once:
+    chunk_rows = int(config.get('UDU_MOLECULAR_CHUNK_ROWS', 0))
+    if chunk_rows > 0:
+        sample_barcodes, new_df, staged_file = stage_molecular_chunks(gcs, filebuffer, column_map, metadata,
+                                                                      chunk_rows, source_format, schema,
+                                                                      compress=compress, names=header_columns,
+                                                                      sep=sep, header_line=header_line, logger=logger)
+        if logger:
+            logger.log_text('uduprocessor: chunked dataframe staging success', severity='INFO')
+    else:
+        # convert blob into dataframe. We may get a parsing exception out of this if e.g. a
+        # row has too many fields:
+        data_df = convert_file_to_dataframe(filebuffer, sep=sep, skiprows=0, header=0, names=header_columns, logger=logger)
+        if logger:
+            logger.log_text('uduprocessor: convert_file_to_dataframe success', severity='INFO')
 
-    # Column headers are sample ids. Glue on new columns with metadata here as well.
-    for i, j in data_df.iteritems():
+        # Reject duplicate and blank features. Do before cleanup, because blanks
+        # will be converted to NANs:
 
-        if i in column_map.keys():
-            map_values[column_map[i]] = [k for d, k in j.iteritems()]
+        id_col = find_key_column(data_df, column_map, logger, 'ID')
+        reject_row_duplicate_or_blank(data_df, logger, 'feature', id_col, header_line=header_line)
 
-        else:
-            for k, m in j.iteritems():
-                new_df_obj = {}
-
-                new_df_obj['sample_barcode'] = i # Normalized to match user_gen
-                new_df_obj['project_id'] = metadata['project_id']
-                new_df_obj['Platform'] = metadata['platform']
-                new_df_obj['Pipeline'] = metadata['pipeline']
-
-                # Optional values
-                new_df_obj['Symbol'] = map_values['Symbol'][k] if 'Symbol' in map_values.keys() else ''
-                new_df_obj['ID'] = map_values['ID'][k] if 'ID' in map_values.keys() else ''
-                new_df_obj['TAB'] = map_values['Tab'][k] if 'Tab' in map_values.keys() else ''
-                new_df_obj['Level'] = m
-                new_df_data.append(new_df_obj)
-    new_df = pd.DataFrame(new_df_data)
-    if logger:
-        logger.log_text('uduprocessor: new dataframe constructed success', severity='INFO')
-
-    # Get unique barcodes and update metadata_data table
-    sample_barcodes = list(set([k for d, k in new_df['sample_barcode'].iteritems()]))
-    sample_metadata_list = []
-    for barcode in sample_barcodes:
-        new_metadata = metadata.copy()
-        new_metadata['sample_barcode'] = barcode
-        sample_metadata_list.append(new_metadata)
-    update_metadata_data_list(config, cloudsql_tables['METADATA_DATA'], sample_metadata_list)
-    if logger:
-        logger.log_text('uduprocessor: update_metadata_data_list success', severity='INFO')
+        # clean-up dataframe. We can get a parsing exception out of this if the table has
+        # only a header, and no rows of data:
+        data_df = cleanup_dataframe(data_df, logger=logger)
+        if logger:
+            logger.log_text('uduprocessor: cleanup_dataframe success', severity='INFO')
+        # Column headers are sample ids. Glue on new columns with metadata here as well.
+        new_df = melt_molecular_dataframe(data_df, column_map, metadata)
+        if logger:
+            logger.log_text('uduprocessor: new dataframe constructed success', severity='INFO')
+        sample_barcodes = list(new_df['sample_barcode'].unique())
 
-    # Update metadata_samples table
-    update_molecular_metadata_samples_list(config, cloudsql_tables['METADATA_SAMPLES'], metadata['data_type'], sample_barcodes)
-    update_metadata_cases(config, cloudsql_tables['METADATA_SAMPLES'])
-    if logger:
-        logger.log_text('uduprocessor: Update metadata_samples table success', severity='INFO')
+    # In chunked mode the staged file is already on disk: make sure it goes away even if
+    # something fails before it is uploaded (uploading closes it too; a second close is harmless):
+    try:
+        # Update metadata_data table with the unique barcodes
+        sample_metadata_list = []
+        for barcode in sample_barcodes:
+            new_metadata = metadata.copy()
+            new_metadata['sample_barcode'] = barcode
+            sample_metadata_list.append(new_metadata)
+        update_metadata_data_list(config, cloudsql_tables['METADATA_DATA'], sample_metadata_list, writer=writer)
+        if logger:
+            logger.log_text('uduprocessor: update_metadata_data_list success', severity='INFO')
 
-    # Generate feature names and bq_mappings
-    table_name = file_data['BIGQUERY_TABLE_NAME']
-    feature_defs = generate_feature_Defs(metadata['data_type'], metadata['project_id'], project_id, bq_dataset, table_name, new_df, logger=logger)
-    if logger:
-        logger.log_text('uduprocessor: generate_feature_Defs success', severity='INFO')
+        # Update metadata_samples table
+        update_molecular_metadata_samples_list(config, cloudsql_tables['METADATA_SAMPLES'], metadata['data_type'], sample_barcodes,
+                                               writer=writer)
+        update_metadata_cases(config, cloudsql_tables['METADATA_SAMPLES'], writer=writer)
+        if logger:
+            logger.log_text('uduprocessor: Update metadata_samples table success', severity='INFO')
 
-    # Update feature_defs table
-    insert_feature_defs_list(config, cloudsql_tables['FEATURE_DEFS'], feature_defs)
-    if logger:
-        logger.log_text('uduprocessor: insert_feature_defs_list success', severity='INFO')
+        # Generate feature names and bq_mappings
+        table_name = file_data['BIGQUERY_TABLE_NAME']
+        feature_defs = generate_feature_Defs(metadata['data_type'], metadata['project_id'], project_id, bq_dataset, table_name, new_df, logger=logger)
+        if logger:
+            logger.log_text('uduprocessor: generate_feature_Defs success', severity='INFO')
 
-    # upload the contents of the dataframe in njson format
-    tmp_bucket = config['tmp_bucket']
-    gcs.convert_df_to_njson_and_upload(new_df, outfilename, metadata=metadata, tmp_bucket=tmp_bucket)
-    if logger:
-        logger.log_text('uduprocessor: convert_df_to_njson_and_upload success', severity='INFO')
+        # Update feature_defs table
+        insert_feature_defs_list(config, cloudsql_tables['FEATURE_DEFS'], feature_defs, writer=writer)
+        if logger:
+            logger.log_text('uduprocessor: insert_feature_defs_list success', severity='INFO')
+
+        # upload the contents of the dataframe in the load format
+        tmp_bucket = config['tmp_bucket']
+        if chunk_rows > 0:
+            gcs.upload_staging_file(staged_file, outfilename, metadata=metadata, tmp_bucket=tmp_bucket)
+            if logger:
+                logger.log_text('uduprocessor: upload_staging_file success', severity='INFO')
+        else:
+            gcs.convert_df_and_upload(new_df, outfilename, source_format=source_format, schema=schema,
+                                      metadata=metadata, tmp_bucket=tmp_bucket, compress=compress)
+            if logger:
+                logger.log_text('uduprocessor: convert_df_and_upload success', severity='INFO')
+    finally:
+        if chunk_rows > 0:
+            staged_file.close()
 
     # Load into BigQuery
     # Using temporary file location (in case we don't have write permissions on user's bucket?)
     source_path = 'gs://' + tmp_bucket + '/' + outfilename
-    schema = get_molecular_schema()
+
+    # When the caller collects the staged files, it loads them (one job per table) and deletes them:
+    if loads is not None:
+        loads.append({
+            'table_name': table_name,
+            'schema': schema,
+            'source_path': source_path,
+            'source_format': source_format,
+            'blob_name': outfilename
+        })
+        return
 
     load_data_from_file.run(
         config,
@@ -147,7 +168,7 @@ def parse_file(project_id, bq_dataset, bucket_name, file_data, filename,
         table_name,
         schema,
         source_path,
-        source_format='NEWLINE_DELIMITED_JSON',
+        source_format=source_format,
         write_disposition='WRITE_APPEND',
         is_schema_file=False,
         logger=logger)
@@ -161,6 +182,91 @@ def parse_file(project_id, bq_dataset, bucket_name, file_data, filename,
     if logger:
         logger.log_text('uduprocessor: Deleted temporary file {0}'.format(outfilename), severity='INFO')
 
+#
+# Chunked version of the convert/check/cleanup/melt steps. Each chunk of rows is reshaped and
+# serialized in the load format to a staging file on disk, so peak memory is bounded by the
+# chunk size. Duplicate and blank feature checks share their counts across chunks. Returns the
+# sample barcodes, a dataframe holding just the unique Symbols (for the feature defs), and the
+# StagingFile, ready for upload:
+#
+def stage_molecular_chunks(gcs, filebuffer, column_map, metadata, chunk_rows,
+                           source_format='NEWLINE_DELIMITED_JSON', schema=None, compress=False,
+                           names=None, sep='\t', header_line=1, logger=None):
+    staged_file = gcs.create_staging_file(compress)
+    sample_barcodes = None
+    symbols = []
+    seen_symbols = set()
+    feature_counts = {}
+    id_col = None
+
+    # A chunk that fails (bad row, duplicate feature, ...) takes the partly written staging file with it.
+    # On success the caller owns the file:
+    try:
+        for data_df in convert_file_to_dataframe_chunks(filebuffer, chunk_rows, sep=sep, skiprows=0,
+                                                        header=0, names=names, logger=logger):
+            if id_col is None:
+                id_col = find_key_column(data_df, column_map, logger, 'ID')
+            reject_row_duplicate_or_blank(data_df, logger, 'feature', id_col, feature_counts=feature_counts,
+                                          header_line=header_line)
+
+            data_df = cleanup_dataframe(data_df, logger=logger)
+            new_df = melt_molecular_dataframe(data_df, column_map, metadata)
+
+            if sample_barcodes is None:
+                sample_barcodes = list(new_df['sample_barcode'].unique())
+            for symbol in pd.unique(new_df['Symbol'].values):
+                if symbol not in seen_symbols:
+                    seen_symbols.add(symbol)
+                    symbols.append(symbol)
+
+            write_df_for_load(new_df, staged_file, source_format, schema)
+
+        # Same check cleanup_dataframe does for a file with only a header row:
+        if sample_barcodes is None:
+            raise UduException("Uploaded file only contained header row")
+    except Exception:
+        staged_file.close()
+        raise
+
+    return sample_barcodes, pd.DataFrame({'Symbol': symbols}), staged_file
+
+#
+# Reshape the sample-by-feature matrix into the long format loaded into BigQuery. This
+# works on the underlying numpy arrays: sample columns are flattened column-major (all
+# rows for the first sample, then the next, etc.), mapped feature columns are tiled once
+# per sample, and the file-level metadata is broadcast as scalars:
+#
+def melt_molecular_dataframe(data_df, column_map, metadata):
+    map_values = {}
+    sample_columns = []
+    for column in data_df.columns:
+        if column in column_map:
+            map_values[column_map[column]] = data_df[column].values
+        else:
+            sample_columns.append(column)
+
+    num_rows = len(data_df.index)
+    num_samples = len(sample_columns)
+
+    def tiled(key):
+        if key in map_values:
+            return np.tile(map_values[key], num_samples)
+        return ''
+
+    levels = data_df[sample_columns].values.ravel(order='F')
+    new_df = pd.DataFrame({
+        'sample_barcode': np.repeat(np.array(sample_columns, dtype=object), num_rows), # Normalized to match user_gen
+        'project_id': metadata['project_id'],
+        'Platform': metadata['platform'],
+        'Pipeline': metadata['pipeline'],
+        # Optional values
+        'Symbol': tiled('Symbol'),
+        'ID': tiled('ID'),
+        'TAB': tiled('Tab'),
+        'Level': levels
+    }, index=np.arange(len(levels)))
+    return new_df
+
 #
 # Given the expected strings coming in from the column headers, which is the ID and which is the Symbol?
 #
@@ -21,14 +21,15 @@ import sys
 
 import pandas as pd
 from isb_cgc_user_data.bigquery_etl.extract.gcloud_wrapper import GcsConnector
-from isb_cgc_user_data.bigquery_etl.extract.utils import convert_file_to_dataframe
+from isb_cgc_user_data.bigquery_etl.extract.utils import convert_file_to_dataframe, convert_buffer_encoding
 from isb_cgc_user_data.bigquery_etl.load import load_data_from_file
 from isb_cgc_user_data.bigquery_etl.transform.tools import cleanup_dataframe
-from isb_cgc_user_data.utils.check_dataframe_dups import reject_row_duplicate_or_blank, find_key_column, reject_dup_col_pre_dataframe
+from isb_cgc_user_data.utils.build_config import config_flag
+from isb_cgc_user_data.utils.check_dataframe_dups import reject_row_duplicate_or_blank, find_key_column, sniff_header
 
 from metadata_updates import update_metadata_data_list, insert_metadata_samples, insert_feature_defs_list
 
-def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, bq_dataset, cloudsql_tables, files, config, logger=None):
+def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, bq_dataset, cloudsql_tables, files, config, logger=None, writer=None):
 
     if logger:
         logger.log_text('uduprocessor: Begin processing user_gen files.', severity='INFO')
@@ -58,6 +59,7 @@ def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, b
 
         # download, convert to df
         filebuffer = gcs.download_blob_to_file(blob_name)
+        filebuffer = convert_buffer_encoding(filebuffer, logger=logger)
 
         # Get column mapping
         column_mapping = get_column_mapping(file['COLUMNS'])
@@ -66,15 +68,15 @@ def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, b
             # Reject duplicate and blank features and barcodes. Do before cleanup, because blanks
             # will be converted to NANs:
 
-            reject_dup_col_pre_dataframe(filebuffer, logger, 'barcode')
+            header_columns, sep, header_line = sniff_header(filebuffer, logger, 'barcode')
 
-            data_df = convert_file_to_dataframe(filebuffer, skiprows=0, header=0)
+            data_df = convert_file_to_dataframe(filebuffer, sep=sep, skiprows=0, header=0, names=header_columns)
 
             # Reject duplicate and blank features. Do before cleanup, because blanks
             # will be converted to NANs:
 
             id_col = find_key_column(data_df, column_mapping, logger, 'sample_barcode')
-            reject_row_duplicate_or_blank(data_df, logger, 'barcode', id_col)
+            reject_row_duplicate_or_blank(data_df, logger, 'barcode', id_col, header_line=header_line)
 
             data_df = cleanup_dataframe(data_df, logger=logger)
 
@@ -88,16 +90,17 @@ def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, b
                 data_df[metadata['case_barcode']][data_df['case_barcode']==None] = 'cgc_' + data_df['sample_barcode'][data_df['case_barcode']==None]
 
             # Generate Metadata for this file
-            insert_metadata(data_df, metadata, cloudsql_tables['METADATA_DATA'], config)
+            insert_metadata(data_df, metadata, cloudsql_tables['METADATA_DATA'], config, writer=writer)
 
         else:
             # convert blob into dataframe
-            new_df = convert_file_to_dataframe(filebuffer, skiprows=0, header=0)
+            header_columns, sep, header_line = sniff_header(filebuffer, logger, 'barcode')
+            new_df = convert_file_to_dataframe(filebuffer, sep=sep, skiprows=0, header=0, names=header_columns)
             new_df = cleanup_dataframe(new_df, logger=logger)
             new_df.rename(columns=column_mapping, inplace=True)
 
             # Generate Metadata for this file
-            insert_metadata(new_df, metadata, cloudsql_tables['METADATA_DATA'], config)
+            insert_metadata(new_df, metadata, cloudsql_tables['METADATA_DATA'], config, writer=writer)
 
             # TODO: Write function to check for case barcodes, for now, we assume each file contains SampleBarcode Mapping
             data_df = pd.merge(data_df, new_df, on='sample_barcode', how='outer')
@@ -110,17 +113,20 @@ def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, b
     data_df['has_mirna'] = 0
     data_df['has_protein'] = 0
     data_df['has_meth'] = 0
-    insert_metadata_samples(config, data_df, cloudsql_tables['METADATA_SAMPLES'])
+    insert_metadata_samples(config, data_df, cloudsql_tables['METADATA_SAMPLES'], writer=writer)
 
     # Update and create bq table file
     temp_outfile = cloudsql_tables['METADATA_SAMPLES'] + '.out'
     tmp_bucket = config['tmp_bucket']
-    gcs.convert_df_to_njson_and_upload(data_df, temp_outfile, tmp_bucket=tmp_bucket)
+    source_format = config.get('UDU_BQ_LOAD_FORMAT', 'NEWLINE_DELIMITED_JSON')
+    schema = generate_bq_schema(all_columns)
+    compress = config_flag(config, 'UDU_STAGING_GZIP')
+    gcs.convert_df_and_upload(data_df, temp_outfile, source_format=source_format, schema=schema,
+                              tmp_bucket=tmp_bucket, compress=compress)
 
     # Using temporary file location (in case we don't have write permissions on user's bucket?
     source_path = 'gs://' + tmp_bucket + '/' + temp_outfile
 
-    schema = generate_bq_schema(all_columns)
     table_name = 'cgc_user_{0}_{1}'.format(user_project_id, study_id)
     load_data_from_file.run(
         config,
@@ -129,7 +135,7 @@ def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, b
         table_name,
         schema,
         source_path,
-        source_format='NEWLINE_DELIMITED_JSON',
+        source_format=source_format,
         write_disposition='WRITE_APPEND',
         is_schema_file=False,
         logger=logger)
@@ -138,7 +144,7 @@ def process_user_gen_files(project_id, user_project_id, study_id, bucket_name, b
     feature_defs = generate_feature_defs(study_id, project_id, bq_dataset, table_name, schema)
 
     # Update feature_defs table
-    insert_feature_defs_list(config, cloudsql_tables['FEATURE_DEFS'], feature_defs)
+    insert_feature_defs_list(config, cloudsql_tables['FEATURE_DEFS'], feature_defs, writer=writer)
 
     # Delete temporary files
     if logger:
@@ -157,14 +163,14 @@ def get_column_mapping(columns):
     return column_map
 
 
-def insert_metadata(data_df, metadata, table, config):
+def insert_metadata(data_df, metadata, table, config, writer=None):
     sample_barcodes = list(set([k for d, k in data_df['sample_barcode'].iteritems()]))
     sample_metadata_list = []
     for barcode in sample_barcodes:
         new_metadata = metadata.copy()
         new_metadata['sample_barcode'] = barcode
         sample_metadata_list.append(new_metadata)
-    update_metadata_data_list(config, table, sample_metadata_list)
+    update_metadata_data_list(config, table, sample_metadata_list, writer=writer)
 
 def generate_bq_schema(columns):
     obj = []
@@ -23,4 +23,13 @@ def read_dict(my_file_name):
                 continue
             split_line = line.split('=')
             retval[split_line[0].strip()] = split_line[1].strip()
-    return retval
\ No newline at end of file
+    return retval
+
+#
+# Values in the dictionary are all strings. Flags are on if set to e.g. True, true, yes or 1:
+#
+
+def config_flag(config, key, default=False):
+    if key not in config:
+        return default
+    return config[key].strip().lower() in ('1', 'true', 'yes', 'on')
@@ -11,30 +11,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import codecs
 import csv
 from isb_cgc_user_data.utils.error_handling import UduException
 
 
 #
 # Do column checking before pandas gets a chance, since it appends _x to
-# duplicate column headings:
+# duplicate column headings. sniff_header reads just the header line of the
+# (already UTF-8) buffer, works out the delimiter and checks the column names.
+# The parser is run with comment='#', so the header is found the way it would
+# find it: anything after a '#' is dropped, and lines left blank are skipped.
+# The buffer is then rewound, and the parser reads the header row again with
+# header=0 and names= the returned columns: that way it still rejects rows with
+# more fields than the header, which it would silently truncate if it were only
+# given names=. Also returns the header's line number in the file (from 1):
 #
 
-def reject_dup_col_pre_dataframe(buffer, logger, name):
+def sniff_header(buffer, logger, name):
 
-    tsvin = csv.reader(buffer, delimiter='\t')
-    first = next(tsvin)
-    buffer.seek(0)
+    start = buffer.tell()
+    line = buffer.readline()
+    header_line = 1
+    if line.startswith(codecs.BOM_UTF8):
+        line = line[len(codecs.BOM_UTF8):]
+    while line:
+        line = line.split('#', 1)[0].rstrip('\r\n')
+        if line.strip():
+            break
+        line = buffer.readline()
+        header_line += 1
 
-    if not first:
+    if not line:
         if logger:
             logger.log_text('uduprocessor: file empty', severity='INFO')
         user_message = "File was empty "
         raise UduException(user_message)
 
+    # Uploads are tab-separated; accept comma-separated files too:
+    sep = ',' if '\t' not in line and ',' in line else '\t'
+    columns = next(csv.reader([line], delimiter=sep))
+    check_header_columns(columns, logger, name)
+    buffer.seek(start)
+    return columns, sep, header_line
+
+
+def check_header_columns(columns, logger, name):
+
     barcode_counts = {}
 
-    for i in first:
+    for i in columns:
         if not i.strip():
             if logger:
                 logger.log_text('uduprocessor: empty {0}'.format(name), severity='INFO')
@@ -49,6 +75,7 @@ def reject_dup_col_pre_dataframe(buffer, logger, name):
             raise UduException(user_message)
         barcode_counts[i] = cur_count + 1
 
+
 #
 # Find the ID column:
 #
@@ -70,30 +97,60 @@ def find_key_column(data_df, column_map, logger, key):
     raise UduException(user_message)
 
 #
-# Reject duplicate features:
+# Reject blank and duplicate features. The checks are done on whole columns, and the offending
+# IDs are logged (with their line in the file, given the header_line sniff_header found; comment
+# and blank lines below the header are not counted) before we raise: the first MAX_LOGGED_ROWS
+# of them, and a count of the rest. The error message is the one for
+# the first offending row. When a file is read in chunks, pass the same feature_counts dict in
+# for every chunk so that duplicates are caught across the whole file:
 #
 
-def reject_row_duplicate_or_blank(data_df, logger, name, id_col):
+MAX_LOGGED_ROWS = 100
+
+def reject_row_duplicate_or_blank(data_df, logger, name, id_col, feature_counts=None, header_line=1):
 
-    feature_counts = {}
+    if feature_counts is None:
+        feature_counts = {}
 
-    for row_index, row in data_df.iterrows():
-        feat = row[id_col]
-        if isinstance(feat, float):
+    ids = data_df.iloc[:, id_col]
+    # Missing IDs come in as NaN, which happens when the file has trailing empty lines:
+    missing = ids.isnull()
+    blank = ids[~missing].str.strip().eq('').reindex(ids.index, fill_value=False)
+    duplicated = ids.duplicated(keep='first')
+    if feature_counts:
+        duplicated |= ids.isin(list(feature_counts))
+    duplicated &= ~missing
+    offending = missing | blank | duplicated
+
+    if offending.any():
+        bad_rows = offending.values.nonzero()[0]
+        if logger:
+            shown = bad_rows[:MAX_LOGGED_ROWS]
+            problems = []
+            for line, feat, is_missing, is_blank in zip(data_df.index[shown] + header_line + 1, ids.iloc[shown],
+                                                       missing.iloc[shown], blank.iloc[shown]):
+                kind = 'missing' if is_missing else ('blank' if is_blank else 'duplicated')
+                problems.append('line {0}: {1} {2}'.format(line, kind, repr(feat)))
+            more = len(bad_rows) - len(shown)
+            logger.log_text('uduprocessor: {0} bad {1} rows: {2}{3}'.format(
+                len(bad_rows), name, '; '.join(problems), ' (and {0} more)'.format(more) if more else ''),
+                severity='INFO')
+
+        first = offending.values.argmax()
+        feat = ids.iloc[first]
+        if missing.iloc[first]:
             if logger:
                 logger.log_text('uduprocessor: float key implies trailing empty line {0}'.format(name), severity='INFO')
             user_message = "Trailing empty lines detected, processing cannot continue"
-            raise UduException(user_message)
-        if not feat.strip():
+        elif blank.iloc[first]:
             if logger:
                 logger.log_text('uduprocessor: empty {0}'.format(name), severity='INFO')
             user_message = "Empty {0} detected in rows, processing cannot continue".format(name)
-            raise UduException(user_message)
-
-        cur_count = feature_counts.get(feat, 0)
-        if cur_count > 0:
+        else:
             if logger:
                 logger.log_text('uduprocessor: duplicated {0}'.format(name), severity='INFO')
             user_message = "Duplicated {0} detected in rows, processing cannot continue: {1}".format(name, str(feat))
-            raise UduException(user_message)
-        feature_counts[feat] = cur_count + 1
+        raise UduException(user_message)
+
+    for feat, count in ids.value_counts().iteritems():
+        feature_counts[feat] = feature_counts.get(feat, 0) + count
@@ -0,0 +1,92 @@
+# Copyright 2017, Institute for Systems Biology.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import threading
+import time
+
+import httplib2
+from oauth2client.client import GoogleCredentials
+
+#
+# We used to pick up config['privatekey_path'] by pointing GOOGLE_APPLICATION_CREDENTIALS
+# at it for a moment, which races as soon as two threads do it. Instead, the service account
+# key is loaded once per file into a CredentialsProvider, and the credentials object is handed
+# to the storage and BigQuery clients explicitly. The credentials are scoped to cloud-platform
+# (which covers both), so the clients use them as they are and do not make scoped copies.
+# A background thread refreshes the access token REFRESH_MARGIN_SECONDS before it expires,
+# so requests do not stall on (or race each other for) a refresh.
+#
+# Cloud SQL is reached through the proxy with a database user and password, so the MySQL
+# connections do not take Google credentials.
+#
+
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+REFRESH_MARGIN_SECONDS = 5 * 60
+RETRY_SECONDS = 30
+
+
+class CredentialsProvider(object):
+    def __init__(self, credential_path, scopes=SCOPES):
+        self.credential_path = credential_path
+        credentials = GoogleCredentials.from_stream(credential_path)
+        if credentials.create_scoped_required():
+            credentials = credentials.create_scoped(scopes)
+        self.credentials = credentials
+        self.last_error = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+        self._thread = threading.Thread(target=self._refresh_loop, name='credentials-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def refresh(self):
+        with self._lock:
+            self.credentials.refresh(httplib2.Http())
+
+    def seconds_to_refresh(self):
+        expiry = self.credentials.token_expiry
+        if expiry is None:
+            return RETRY_SECONDS
+        remaining = expiry - datetime.datetime.utcnow()
+        seconds = remaining.days * 86400 + remaining.seconds - REFRESH_MARGIN_SECONDS
+        return max(seconds, 0)
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.seconds_to_refresh())
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as exp:
+                # Requests will still refresh on demand; try again shortly:
+                self.last_error = exp
+                time.sleep(RETRY_SECONDS)
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_credentials_provider(credential_path):
+    with _providers_lock:
+        provider = _providers.get(credential_path)
+        if provider is None:
+            provider = CredentialsProvider(credential_path)
+            _providers[credential_path] = provider
+    return provider
+
+
+def get_credentials(credential_path):
+    return get_credentials_provider(credential_path).credentials
@@ -0,0 +1,157 @@
+# Copyright 2017, Institute for Systems Biology.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+import uuid
+
+from isb_cgc_user_data.utils.sql_connector import cloudsql_connection
+
+#
+# Pub/Sub may deliver a job more than once, and several workers (on several hosts) may be
+# pulling from the subscription. Before running a job, a worker claims it with a row in the
+# claim table. The claim is a single INSERT ... ON DUPLICATE KEY UPDATE, and the worker then
+# reads back the row's claim token, so exactly one worker wins:
+#
+#  - no row yet: the row is inserted (state 'running', attempt 1, our token) and we own the job.
+#  - a 'running' row whose heartbeat is STALE_HEARTBEATS beats old: its worker died, so the row
+#    is taken over (attempts + 1, our token) and we own the job.
+#  - anything else ('running' and alive, 'done', 'failed'): the row keeps its owner's token. The
+#    job is a duplicate, and the caller gets the state the row is in.
+#
+# Every delivery, won or not, is counted in the row (deliveries, last_message_id), so the table
+# shows how often Pub/Sub and the local queue handed the same job out.
+#
+# The key is the config file name alone, not (config file, message ID). The same job reaches the
+# workers under different message IDs: once through Pub/Sub and once through the local queue, and
+# Pub/Sub may redeliver under a new ID too. Keying on the message ID would run those copies twice.
+# Config file names are unique per submission (the UDU server time stamps them), so two different
+# jobs never share a claim.
+#
+# While a job runs, its claim's heartbeat (updated_at) is refreshed every heartbeat_seconds. A
+# duplicate of a job that is still running must not be acknowledged: its worker could still die,
+# and then the next delivery has to find the stale claim and take the job over. The worker runner
+# hands such duplicates back to Pub/Sub with a delay longer than the stale window (see
+# RECHECK_SECONDS there). The Pub/Sub lease (60 seconds) is much shorter than the stale window,
+# which is fine: a lease that runs out early only brings back a duplicate, which is handed back.
+#
+# 'done' and 'failed' are final. A failed job has already reported its error to the web app
+# through failure_url, and the user has seen it; most failures are in the uploaded data, so
+# running it again would fail again. The user retries by submitting again, which writes a new
+# (time stamped) config file and so gets a new claim. To rerun a job by hand, delete its row.
+#
+
+CLAIM_TABLE = 'udu_job_claims'
+HEARTBEAT_SECONDS = 60
+STALE_HEARTBEATS = 5
+
+_CREATE_STMT = '''CREATE TABLE IF NOT EXISTS {0} (
+    config_file VARCHAR(255) NOT NULL PRIMARY KEY,
+    message_id VARCHAR(64),
+    claim_token CHAR(32) NOT NULL,
+    state VARCHAR(16) NOT NULL,
+    attempts INT NOT NULL,
+    deliveries INT NOT NULL,
+    last_message_id VARCHAR(64),
+    worker VARCHAR(255),
+    claimed_at DATETIME NOT NULL,
+    updated_at DATETIME NOT NULL
+);'''
+
+# MySQL applies the assignments in order, so updated_at (part of the stale test) must come last:
+_STALE = "(state = 'running' AND updated_at < UTC_TIMESTAMP() - INTERVAL {1:d} SECOND)"
+_CLAIM_STMT = '''INSERT INTO {0} (config_file, message_id, claim_token, state, attempts, deliveries,
+                    last_message_id, worker, claimed_at, updated_at)
+    VALUES (%s, %s, %s, 'running', 1, 1, %s, %s, UTC_TIMESTAMP(), UTC_TIMESTAMP())
+    ON DUPLICATE KEY UPDATE
+    deliveries = deliveries + 1,
+    last_message_id = VALUES(last_message_id),
+    attempts = IF(STALE, attempts + 1, attempts),
+    message_id = IF(STALE, VALUES(message_id), message_id),
+    claim_token = IF(STALE, VALUES(claim_token), claim_token),
+    worker = IF(STALE, VALUES(worker), worker),
+    claimed_at = IF(STALE, VALUES(claimed_at), claimed_at),
+    updated_at = IF(STALE, VALUES(updated_at), updated_at);'''.replace('STALE', _STALE)
+
+_created_tables = set()
+_created_lock = threading.Lock()
+
+
+class JobClaim(object):
+    def __init__(self, config, config_file, message_id=None):
+        self.config = config
+        self.config_file = config_file
+        self.message_id = message_id
+        self.table = config.get('UDU_JOB_CLAIM_TABLE', CLAIM_TABLE)
+        self.heartbeat_seconds = int(config.get('UDU_JOB_HEARTBEAT_SECONDS', HEARTBEAT_SECONDS))
+        self.worker = '{0}:{1}'.format(socket.gethostname(), threading.current_thread().name)
+        self.token = uuid.uuid4().hex
+        self._done = threading.Event()
+
+    def claim(self):
+        self._create_table()
+        with cloudsql_connection(self.config) as db:
+            cursor = db.cursor()
+            claim_stmt = _CLAIM_STMT.format(self.table, self.heartbeat_seconds * STALE_HEARTBEATS)
+            cursor.execute(claim_stmt, (self.config_file, self.message_id, self.token, self.message_id, self.worker))
+            cursor.execute('SELECT claim_token FROM {0} WHERE config_file = %s;'.format(self.table), (self.config_file,))
+            claimed = cursor.fetchone()[0] == self.token
+            db.commit()
+            cursor.close()
+        if claimed:
+            heartbeat = threading.Thread(target=self._heartbeat, name='claim-heartbeat')
+            heartbeat.daemon = True
+            heartbeat.start()
+        return claimed
+
+    # state and attempt count, for logging why a claim failed
+    def current(self):
+        with cloudsql_connection(self.config) as db:
+            cursor = db.cursor()
+            cursor.execute('SELECT state, attempts FROM {0} WHERE config_file = %s;'.format(self.table),
+                           (self.config_file,))
+            row = cursor.fetchone()
+            cursor.close()
+        return row
+
+    def finish(self, state):
+        self._done.set()
+        self._update('UPDATE {0} SET state = %s, updated_at = UTC_TIMESTAMP() WHERE config_file = %s AND claim_token = %s;',
+                     (state, self.config_file, self.token))
+
+    def _heartbeat(self):
+        while not self._done.wait(self.heartbeat_seconds):
+            try:
+                self._update("UPDATE {0} SET updated_at = UTC_TIMESTAMP() "
+                             "WHERE config_file = %s AND claim_token = %s AND state = 'running';",
+                             (self.config_file, self.token))
+            except Exception:
+                # A missed beat or two is harmless; the claim only goes stale after several
+                pass
+
+    def _update(self, stmt, args):
+        with cloudsql_connection(self.config) as db:
+            cursor = db.cursor()
+            cursor.execute(stmt.format(self.table), args)
+            db.commit()
+            cursor.close()
+
+    def _create_table(self):
+        with _created_lock:
+            if self.table in _created_tables:
+                return
+            with cloudsql_connection(self.config) as db:
+                cursor = db.cursor()
+                cursor.execute(_CREATE_STMT.format(self.table))
+                cursor.close()
+            _created_tables.add(self.table)
@@ -1,29 +1,142 @@
-
+import sys
+import threading
+import time
+from contextlib import contextmanager
 
 import MySQLdb
 
 def cloudsql_connector(config):
+    options = {}
     if 'ssl_cert' in config:
-        ssl_options = {
+        options['ssl'] = {
             'ca': config['ssl_ca'],
             'cert': config['ssl_cert'],
             'key': config['ssl_key']
         }
 
-        db = MySQLdb.connect(
+    # Needed for the LOAD DATA LOCAL INFILE path of the metadata writer
+    if int(config.get('UDU_SQL_LOAD_DATA_ROWS', 0)) > 0:
+        options['local_infile'] = 1
+
+    db = MySQLdb.connect(
             host=config['db_host'],
             db=config['db'],
             user=config['db_user'],
             passwd=config['db_password'],
-            ssl=ssl_options
-        )
-    else:
-
-        db = MySQLdb.connect(
-                host=config['db_host'],
-                db=config['db'],
-                user=config['db_user'],
-                passwd=config['db_password']
-        )
-
-    return db
\ No newline at end of file
+            **options
+    )
+
+    return db
+
+#
+# Opening a connection through the SQL proxy costs a full (SSL) handshake, so
+# connections are pooled and shared by all the metadata writes. The pool holds
+# at most max_size connections. An idle connection is pinged before it is handed
+# out, and replaced if the ping fails (e.g. the server timed it out).
+#
+# A connection always goes back with its transaction ended: whatever the borrower
+# did not commit is rolled back. Otherwise a read-only borrower (a SELECT with no
+# commit) would leave a transaction open, and the next borrower would read from
+# its old REPEATABLE READ snapshot:
+#
+
+POOL_SIZE = 4
+PING_AFTER_IDLE_SECONDS = 30
+
+
+class CloudSqlPool(object):
+    def __init__(self, config, max_size=POOL_SIZE):
+        self.config = config
+        self.max_size = max_size
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def get(self):
+        self._slots.acquire()
+        try:
+            with self._lock:
+                idle = self._idle.pop() if self._idle else None
+            if idle is not None:
+                db, last_used = idle
+                if time.time() - last_used < PING_AFTER_IDLE_SECONDS or self._is_healthy(db):
+                    return db
+                self._discard(db)
+            return cloudsql_connector(self.config)
+        except:
+            self._slots.release()
+            raise
+
+    def put(self, db, broken=False):
+        try:
+            if broken:
+                self._discard(db)
+            else:
+                with self._lock:
+                    self._idle.append((db, time.time()))
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db, _ in idle:
+            self._discard(db)
+
+    @contextmanager
+    def connection(self):
+        db = self.get()
+        try:
+            yield db
+        except:
+            exc_info = sys.exc_info()
+            # A lost connection (or one we cannot roll back) is not handed out again
+            broken = isinstance(exc_info[1], MySQLdb.OperationalError) or not self._rollback(db)
+            self.put(db, broken=broken)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            self.put(db, broken=not self._rollback(db))
+
+    def _rollback(self, db):
+        try:
+            db.rollback()
+            return True
+        except MySQLdb.Error:
+            return False
+
+    def _is_healthy(self, db):
+        try:
+            db.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+
+    def _discard(self, db):
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_cloudsql_pool(config):
+    key = (config['db_host'], config['db'], config['db_user'])
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = CloudSqlPool(config, max_size=int(config.get('UDU_SQL_POOL_SIZE', POOL_SIZE)))
+            _pools[key] = pool
+    return pool
+
+
+#
+# Use as:
+#   with cloudsql_connection(config) as db:
+#       ...
+#
+
+def cloudsql_connection(config):
+    return get_cloudsql_pool(config).connection()
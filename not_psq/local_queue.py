@@ -0,0 +1,132 @@
+#
+# Copyright 2017, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import json
+import os
+import time
+import uuid
+
+from .task import Task
+
+#
+# A queue of tasks kept as files in a spool directory, for the UDU server and the workers
+# running on the same host. The server drops each task here as well as publishing it to
+# Pub/Sub, and a local worker picks it up within POLL_SECONDS. Pub/Sub stays the durable
+# copy: if the local task is lost (or the worker dies), the Pub/Sub message still gets
+# delivered, and the job claim table makes sure the job only runs once either way.
+#
+# Task files are written under a temporary name and renamed into place, and a worker takes
+# a task by renaming it to its own name (tagged with its pid), so several worker processes can
+# share a directory. Tasks taken by a worker that has since died are put back when a queue is
+# opened on the directory. Same interface as Queue (enqueue/dequeue/acknowledge/release/close).
+#
+
+POLL_SECONDS = 0.5
+TASK_SUFFIX = '.task'
+
+
+class LocalQueue(object):
+    def __init__(self, spool_dir, poll_seconds=POLL_SECONDS):
+        self.spool_dir = spool_dir
+        self.poll_seconds = poll_seconds
+        if not os.path.isdir(spool_dir):
+            try:
+                os.makedirs(spool_dir)
+            except OSError:
+                # Someone else made it first
+                if not os.path.isdir(spool_dir):
+                    raise
+        self._requeue_orphans()
+
+    # Puts back the tasks taken by worker processes that are no longer running:
+    def _requeue_orphans(self):
+        for name in os.listdir(self.spool_dir):
+            task_name, _, pid = name[1:].rpartition('.')
+            if not (name.startswith('.') and task_name.endswith(TASK_SUFFIX) and pid.isdigit()):
+                continue
+            pid = int(pid)
+            if pid == os.getpid() or _is_running(pid):
+                continue
+            try:
+                os.rename(os.path.join(self.spool_dir, name), os.path.join(self.spool_dir, task_name))
+            except OSError:
+                # Another process put it back first
+                pass
+
+    def enqueue(self, task):
+        name = '{0:.6f}-{1}'.format(time.time(), uuid.uuid4().hex)
+        temp_path = os.path.join(self.spool_dir, '.' + name)
+        with open(temp_path, 'w') as f:
+            json.dump(task.getMsg(), f)
+        os.rename(temp_path, os.path.join(self.spool_dir, name + TASK_SUFFIX))
+
+    #
+    # Returns up to max_messages tasks, oldest first, waiting at most `wait` seconds for one
+    # to show up (None if none did):
+    #
+
+    def dequeue(self, max_messages=1, wait=5):
+        deadline = time.time() + wait
+        while True:
+            tasks = self._take(max_messages)
+            if tasks or time.time() >= deadline:
+                return tasks or None
+            time.sleep(self.poll_seconds)
+
+    def _take(self, max_messages):
+        tasks = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            if len(tasks) >= max_messages:
+                break
+            if not name.endswith(TASK_SUFFIX):
+                continue
+            claimed_path = os.path.join(self.spool_dir, '.{0}.{1}'.format(name, os.getpid()))
+            try:
+                os.rename(os.path.join(self.spool_dir, name), claimed_path)
+            except OSError:
+                # Another worker took it
+                continue
+            with open(claimed_path, 'r') as f:
+                msg = json.load(f)
+            tasks.append(Task(msg, name[:-len(TASK_SUFFIX)], ack_id=claimed_path, pulled_at=time.time()))
+        return tasks
+
+    def acknowledge(self, tasks):
+        for task in tasks or []:
+            try:
+                os.remove(task.getAckID())
+            except OSError:
+                pass
+
+    # Puts tasks back for another worker. Local tasks are not retried later (Pub/Sub does
+    # that), so a delay means the task is dropped:
+    def release(self, tasks, delay=0):
+        for task in tasks or []:
+            if delay:
+                self.acknowledge([task])
+            else:
+                os.rename(task.getAckID(), os.path.join(self.spool_dir, task.getID() + TASK_SUFFIX))
+
+    def close(self):
+        pass
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exp:
+        return exp.errno == errno.EPERM
+    return True
@@ -0,0 +1,83 @@
+#
+# Copyright 2017, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from .queue import Queue, retry_pubsub
+
+#
+# A long-lived publisher for a process that sends tasks to the queue. It builds the Pub/Sub
+# client and topic handle once (checking the topic exists only then, retried like a publish),
+# and only builds a new client when a publish fails with a RetryError (see retry_pubsub).
+#
+# Publishes are group committed: a caller that finds a publish already in progress waits for
+# it, and then sends everything that queued up meanwhile in one batch request. A lone caller
+# publishes right away, so it never waits for a batch to fill up.
+#
+
+
+class _Pending(object):
+    def __init__(self, task):
+        self.task = task
+        self.done = False
+        self.error = None
+
+
+class Publisher(object):
+    # make_client builds a Pub/Sub client, e.g. lambda: pubsub.Client(project=PROJECT_ID)
+    def __init__(self, make_client, topic_name):
+        self.make_client = make_client
+        self.topic_name = topic_name
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self.queue = self._connect_checked()
+
+    # Each attempt builds a new client anyway, so there is nothing to reconnect between them:
+    def _connect_checked(self):
+        @retry_pubsub(lambda: None)
+        def connect():
+            return self._connect(check_topic=True)
+        return connect()
+
+    def _connect(self, check_topic=False):
+        return Queue(self.make_client(), name=self.topic_name, check_topic=check_topic)
+
+    def _reconnect(self):
+        self.queue = self._connect()
+
+    def publish(self, task):
+        pending = _Pending(task)
+        with self._pending_lock:
+            self._pending.append(pending)
+        with self._publish_lock:
+            if not pending.done:
+                with self._pending_lock:
+                    batch, self._pending = self._pending, []
+                self._publish_batch(batch)
+        if pending.error is not None:
+            raise pending.error
+
+    def _publish_batch(self, batch):
+        @retry_pubsub(self._reconnect)
+        def send():
+            self.queue.enqueue_batch([pending.task for pending in batch])
+        try:
+            send()
+        except Exception as exp:
+            for pending in batch:
+                pending.error = exp
+        for pending in batch:
+            pending.done = True
@@ -32,19 +32,44 @@
 # limitations under the License.
 
 from gcloud import pubsub
+from google.gax.errors import RetryError
+from retrying import retry
 from .task import Task
 import sys
 import json
+import threading
+import time
 
 PUBSUB_OBJECT_PREFIX = 'psq'
 
+#
+# The one retry policy for Pub/Sub calls: on a RetryError, call reconnect() (to get a fresh
+# client), wait RETRY_WAIT_MS and try again, RETRY_ATTEMPTS times in all. Anything else is
+# raised straight away. Use as a decorator: @retry_pubsub(reconnect)
+#
+
+RETRY_ATTEMPTS = 10
+RETRY_WAIT_MS = 2000
+
+
+def retry_pubsub(reconnect):
+    def retry_on(exp):
+        if not isinstance(exp, RetryError):
+            return False
+        reconnect()
+        return True
+    return retry(stop_max_attempt_number=RETRY_ATTEMPTS, wait_fixed=RETRY_WAIT_MS, retry_on_exception=retry_on)
+
+
 class Queue(object):
-    def __init__(self, pubsub, name='default'):
+    # check_topic=False skips the topic.exists() round trip, for a topic known to be there
+    def __init__(self, pubsub, name='default', check_topic=True):
         self.name = name
         self._check_for_thread_safety(pubsub)
         self.pubsub = pubsub
-        self.topic = self._get_or_create_topic()
+        self.topic = self._get_or_create_topic(check_topic)
         self.subscription = None
+        self.lease_keeper = None
 
     def _check_for_thread_safety(self, client):
         try:
@@ -72,12 +97,12 @@ class Queue(object):
             pass
 
 
-    def _get_or_create_topic(self):
+    def _get_or_create_topic(self, check_topic=True):
         topic_name = '{}-{}'.format(PUBSUB_OBJECT_PREFIX, self.name)
 
         topic = self.pubsub.topic(topic_name)
 
-        if not topic.exists():
+        if check_topic and not topic.exists():
             try:
                 topic.create()
             except google.cloud.exceptions.Conflict:
@@ -107,23 +132,110 @@ class Queue(object):
     def enqueue(self, task):
         self.topic.publish(json.dumps(task.getMsg()))
 
-    def dequeue(self):
+    # Publishes the tasks in one request
+    def enqueue_batch(self, tasks):
+        with self.topic.batch() as batch:
+            for task in tasks:
+                batch.publish(json.dumps(task.getMsg()))
+
+    #
+    # Pulls up to max_messages tasks. The messages are NOT acknowledged here: each task carries
+    # its ack_id, and its lease (ack deadline) is extended in the background until the caller
+    # acknowledges it, after the job has run. If the worker dies first, Pub/Sub redelivers it.
+    #
+
+    def dequeue(self, max_messages=1):
         if not self.subscription:
             self.subscription = self._get_or_create_subscription()
 
-        messages = self.subscription.pull(return_immediately=False, max_messages=1)
+        messages = self.subscription.pull(return_immediately=False, max_messages=max_messages)
 
         if not messages:
             return None
 
-        ack_ids = [x[0] for x in messages]
-
         tasks = []
+        pulled_at = time.time()
         for x in messages:
-            task = Task(json.loads(x[1].data), x[1].message_id)
+            task = Task(json.loads(x[1].data), x[1].message_id, ack_id=x[0], pulled_at=pulled_at)
             tasks.append(task)
 
-        self.subscription.acknowledge(ack_ids)
+        self._get_lease_keeper().hold(tasks)
 
         return tasks
 
+    def acknowledge(self, tasks):
+        if not tasks:
+            return
+        self._get_lease_keeper().release(tasks)
+        self.subscription.acknowledge([task.getAckID() for task in tasks])
+
+    # Hands unprocessed tasks back to Pub/Sub for redelivery (to any worker) after delay seconds
+    # (at most 600)
+    def release(self, tasks, delay=0):
+        if not tasks:
+            return
+        self._get_lease_keeper().release(tasks)
+        self.extend_lease(tasks, delay)
+
+    def extend_lease(self, tasks, seconds):
+        self.subscription.modify_ack_deadline([task.getAckID() for task in tasks], seconds)
+
+    # The tasks still held keep their leases until they are acknowledged or released
+    def close(self):
+        if self.lease_keeper is not None:
+            self.lease_keeper.stop()
+
+    def _get_lease_keeper(self):
+        if self.lease_keeper is None:
+            self.lease_keeper = LeaseKeeper(self)
+        return self.lease_keeper
+
+
+#
+# Keeps the pulled but not yet acknowledged tasks of a queue leased: every
+# ack_deadline / 3 seconds, their ack deadline is pushed out to ack_deadline
+# seconds from now. Runs on a daemon thread, so it goes away with the worker,
+# and the leases then run out and the tasks are redelivered.
+#
+
+ACK_DEADLINE_SECONDS = 60
+
+
+class LeaseKeeper(object):
+    def __init__(self, queue, ack_deadline=ACK_DEADLINE_SECONDS):
+        self.queue = queue
+        self.ack_deadline = ack_deadline
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-keeper')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def hold(self, tasks):
+        with self._lock:
+            for task in tasks:
+                self._held[task.getAckID()] = task
+        self.queue.extend_lease(tasks, self.ack_deadline)
+
+    def release(self, tasks):
+        with self._lock:
+            for task in tasks:
+                self._held.pop(task.getAckID(), None)
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ack_deadline / 3.0)
+            with self._lock:
+                tasks = self._held.values()
+            if not tasks:
+                if self._stop.is_set():
+                    return
+                continue
+            try:
+                self.queue.extend_lease(tasks, self.ack_deadline)
+            except Exception as exp:
+                print >> sys.stderr, 'lease extension failed: {0}'.format(exp)
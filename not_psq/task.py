@@ -32,9 +32,11 @@
 # limitations under the License.
 
 class Task(object):
-    def __init__(self, msg, id=None):
+    def __init__(self, msg, id=None, ack_id=None, pulled_at=None):
         self.id = id
         self.msg = msg
+        self.ack_id = ack_id
+        self.pulled_at = pulled_at
 
     def getID(self):
         return self.id
@@ -42,5 +44,8 @@ class Task(object):
     def getMsg(self):
         return self.msg
 
+    def getAckID(self):
+        return self.ack_id
+
 
 
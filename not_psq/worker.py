@@ -34,8 +34,9 @@
 from retrying import retry
 
 class Worker(object):
-    def __init__(self, queue):
+    def __init__(self, queue, max_messages=1):
         self.queue = queue
+        self.max_messages = max_messages
         self.max_sequential_errors = 5
 
     def _safe_dequeue(self):
@@ -46,16 +47,19 @@ class Worker(object):
             wait_exponential_multiplier=1000, wait_exponential_max=10000,
             retry_on_exception=lambda e: not isinstance(e, KeyboardInterrupt))
         def inner():
-            return self.queue.dequeue()
+            return self.queue.dequeue(self.max_messages)
         return inner()
 
-    def listen(self):
+    def listen(self, stopping=None):
         try:
             while True:
 
                 tasks = self._safe_dequeue()
 
                 if not tasks:
+                    # Give up waiting if we are being shut down:
+                    if stopping is not None and stopping.is_set():
+                        return None
                     continue
 
                 return (tasks);
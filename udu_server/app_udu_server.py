@@ -21,7 +21,8 @@ from flask_basicauth import BasicAuth
 from google.cloud import pubsub, logging
 import datetime
 from not_psq.task import Task
-from not_psq.queue import Queue
+from not_psq.publisher import Publisher
+from not_psq.local_queue import LocalQueue
 from not_psq.safe_logger import Safe_Logger
 import sys
 import time
@@ -56,9 +57,9 @@ my_config = read_dict('../config/udu_config.txt')
 PROJECT_ID = my_config['UDU_PSQ_PROJECT_ID']
 UPLOAD_FOLDER = my_config['UDU_UPLOAD_FOLDER']
 RESPONSE_LOCATION_PREFIX = my_config['UDU_RESPONSE_LOCATION']
-PING_COUNT = int(my_config['UDU_PING_COUNT'])
 STACKDRIVER_LOG = my_config['UDU_STACKDRIVER_LOG']
 PSQ_TOPIC_NAME = my_config['UDU_PSQ_TOPIC_NAME']
+LOCAL_QUEUE_DIR = my_config.get('UDU_LOCAL_QUEUE_DIR', os.path.join(UPLOAD_FOLDER, 'local_queue'))
 
 # FLASK
 app = Flask(__name__)
@@ -71,6 +72,12 @@ basic_auth = BasicAuth(app)
 
 logger = Safe_Logger(STACKDRIVER_LOG)
 
+# PUB/SUB: one publisher for the life of the server. Fast path to the workers on this host
+# (see run_udu_job):
+
+publisher = Publisher(lambda: pubsub.Client(project=PROJECT_ID), PSQ_TOPIC_NAME)
+local_queue = LocalQueue(LOCAL_QUEUE_DIR)
+
 #
 # This is the guts of the server. Takes UDU job requests and queues them up
 # for execution using psq:
@@ -109,59 +116,32 @@ def run_udu_job():
 
         #
         # WJRL 3/19/17: Google Pub/Sub behaves terribly if there is only one message
-        # published to a topic. It sits for ~10 minutes, or even more. We can deal with
-        # this by creating a pile of no-op calls before and after to flush the message
-        # queue:
+        # published to a topic. It sits for ~10 minutes, or even more. We used to flush it
+        # through with a pile of no-op pings before and after. Instead, the task is published
+        # to Pub/Sub (the durable copy, for any worker) and also dropped into the local queue,
+        # which the workers on this host poll every fraction of a second. Whichever copy a
+        # worker gets first runs the job; the job claim table turns the other into a duplicate.
         #
-            pubsub_client = pubsub.Client(project=PROJECT_ID)
-            q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-
-            logger.log_text('pub/sub stuffing with preamble pings', severity='INFO')
-            for _ in xrange(PING_COUNT):
-                try:
-                    ping_task = {
-                        'method': 'ping'
-                    }
-                    q.enqueue(Task(ping_task))
-                except RetryError:
-                    time.sleep(2)
-                    pubsub_client = pubsub.Client(project=PROJECT_ID)
-                    q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-
-            sending = True
-            try_count = 10
-            while sending and try_count > 0:
-                try:
-                    logger.log_text('pub/sub issuing processing request', severity='INFO')
-                    user_process_task = {
-                        'method': 'buildWithParameters',
-                        'file_name': my_file_name,
-                        'success_url': success_url,
-                        'failure_url': failure_url
-                    }
-                    q.enqueue(Task(user_process_task))
-                    sending = False
-                except RetryError:
-                    time.sleep(2)
-                    pubsub_client = pubsub.Client(project=PROJECT_ID)
-                    q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-                    try_count -= 1
-
-            if try_count <= 0:
+            user_process_task = {
+                'method': 'buildWithParameters',
+                'file_name': my_file_name,
+                'success_url': success_url,
+                'failure_url': failure_url,
+                'submitted_at': time.time()
+            }
+
+            logger.log_text('pub/sub issuing processing request', severity='INFO')
+            try:
+                publisher.publish(Task(user_process_task))
+            except RetryError:
                 print 'pub/sub failure'
                 return abort(400)
 
-            logger.log_text('pub/sub stuffing with postscript pings', severity='INFO')
-            for _ in xrange(PING_COUNT):
-                try:
-                    ping_task = {
-                        'method': 'ping'
-                    }
-                    q.enqueue(Task(ping_task))
-                except RetryError:
-                    time.sleep(2)
-                    pubsub_client = pubsub.Client(project=PROJECT_ID)
-                    q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
+            try:
+                local_queue.enqueue(Task(user_process_task))
+            except (IOError, OSError) as exp:
+                # Not fatal: the Pub/Sub copy still gets there, just more slowly
+                logger.log_text('local queue enqueue failed: {0}'.format(str(exp)), severity='WARNING')
 
             resp = make_response(jsonify("processing"))
             resp.headers['Location'] = RESPONSE_LOCATION_PREFIX + processed_name(my_file_name)
@@ -182,25 +162,13 @@ def run_udu_job():
 
 @app.route('/pipePing', methods=['GET'])
 def pinger():
-    pubsub_client = pubsub.Client(project=PROJECT_ID)
-    q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-    sending = True
-    try_count = 10
-    while sending and try_count > 0:
-        logger.log_text('processing ping request', severity='INFO')
-        try:
-            ping_task = {
-                'method': 'ping'
-            }
-            q.enqueue(Task(ping_task))
-            sending = False
-        except RetryError:
-            time.sleep(2)
-            pubsub_client = pubsub.Client(project=PROJECT_ID)
-            q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-            try_count -= 1
-
-    if try_count <= 0:
+    logger.log_text('processing ping request', severity='INFO')
+    ping_task = {
+        'method': 'ping'
+    }
+    try:
+        publisher.publish(Task(ping_task))
+    except RetryError:
         print 'pub/sub failure'
         return abort(400)
 
@@ -14,13 +14,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import signal
 import sys
+import threading
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from gcloud import pubsub
-from not_psq.queue import Queue
+from not_psq.queue import Queue, retry_pubsub
+from not_psq.local_queue import LocalQueue
 from not_psq.worker import Worker
 from isb_cgc_user_data.utils.build_config import read_dict
+from isb_cgc_user_data.bigquery_etl.utils.bigquery_service import set_timing_hook
+from isb_cgc_user_data.utils.job_claims import HEARTBEAT_SECONDS, STALE_HEARTBEATS
 from google.gax.errors import RetryError
 import isb_cgc_user_data.uduprocessor
 
@@ -34,42 +42,261 @@ my_config.update(my_secrets)
 
 PROJECT_ID = my_config['UDU_PSQ_PROJECT_ID']
 PSQ_TOPIC_NAME = my_config['UDU_PSQ_TOPIC_NAME']
+MAX_MESSAGES = int(my_config.get('UDU_PSQ_MAX_MESSAGES', 10))
+LOCAL_QUEUE_DIR = my_config.get('UDU_LOCAL_QUEUE_DIR', os.path.join(my_config['UDU_UPLOAD_FOLDER'], 'local_queue'))
 
 
-def main():
-    print >> sys.stderr, 'Not PSQ has Started for {0}'.format(PSQ_TOPIC_NAME)
-    pubsub_client = pubsub.Client(project=PROJECT_ID)
-    q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-    worker = Worker(q)
-    while True:
-        listening = True
-        try_count = 10
-        while listening and try_count > 0:
-            try:
-                tasks = worker.listen() # will block until exception or we have a task
-                listening = False
-            except RetryError:
-                if try_count <= 0:
-                    raise
-                time.sleep(2)
-                pubsub_client = pubsub.Client(project=PROJECT_ID)
-                q = Queue(pubsub_client, name=PSQ_TOPIC_NAME)
-                worker = Worker(q)
-                try_count -= 1
-
-        for task in tasks:
-            to_do = task.getMsg()
-            if 'method' not in to_do:
-                print >> sys.stderr, 'unexpected task contents: {0}'.format(to_do)
-            # Using 'is' here instead of == means no matches... because the string is built from bytes coming over the wire??
-            elif to_do['method'] == 'buildWithParameters':
-                print >> sys.stderr, 'Job {0} received at: {1}'.format(to_do['file_name'], str(datetime.now()))
-                isb_cgc_user_data.uduprocessor.process_upload(to_do['file_name'], to_do['success_url'], to_do['failure_url'])
-                print >> sys.stderr, 'Job {0} finished at: {1}'.format(to_do['file_name'], str(datetime.now()))
-            elif to_do['method'] == 'ping':
-                print >> sys.stderr, 'Pipe pinged at: {0}'.format(str(datetime.now()))
+#
+# The runner keeps up to WORKER_THREADS jobs going at once, so one big upload does not hold up
+# everybody else's jobs. It only pulls as many tasks as it has free threads, so tasks it cannot
+# start yet stay in the subscription for other workers. On SIGTERM it stops pulling, hands back
+# anything pulled but not started, waits for the running jobs to finish, and exits. (supervisord
+# must give it long enough: see stopwaitsecs in psqworker.conf.)
+#
+
+WORKER_THREADS = int(my_config.get('UDU_WORKER_THREADS', 4))
+METRICS_EVERY = 10
+
+#
+# A duplicate of a job that is still running elsewhere is never acknowledged, but handed back for
+# RECHECK_SECONDS (the longest ack deadline Pub/Sub allows). That has to be longer than it takes
+# the running job's claim to go stale, so that if its worker dies, the next delivery takes it over:
+#
+
+RECHECK_SECONDS = 600
+CLAIM_STALE_SECONDS = int(my_config.get('UDU_JOB_HEARTBEAT_SECONDS', HEARTBEAT_SECONDS)) * STALE_HEARTBEATS
+
+
+class JobMetrics(object):
+    """Job duration and queue wait (from submission when the message
+    says when that was, otherwise from being pulled) for finished tasks,
+    and how many BigQuery services were built (and how long that took).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.service_builds = 0
+        self.service_build_seconds = 0.0
+        self.service_gets = 0
+
+    def record(self, wait, duration):
+        with self._lock:
+            self.count += 1
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if self.count % METRICS_EVERY == 0:
+                self._report()
+
+    # The bigquery_service timing hook:
+    def record_service(self, event, seconds):
+        with self._lock:
+            if event == 'build':
+                self.service_builds += 1
+                self.service_build_seconds += seconds
             else:
-                print >> sys.stderr, 'unexpected method call: {0} at {1}'.format(to_do['method'], str(datetime.now()))
+                self.service_gets += 1
+
+    def report(self):
+        with self._lock:
+            self._report()
+
+    def _report(self):
+        if not self.count:
+            return
+        print >> sys.stderr, 'Jobs: {0} done; duration mean {1:.1f}s max {2:.1f}s; queue wait mean {3:.1f}s max {4:.1f}s'.format(
+            self.count, self.total_duration / self.count, self.max_duration,
+            self.total_wait / self.count, self.max_wait)
+        print >> sys.stderr, 'BigQuery services: {0} built in {1:.1f}s total, for {2} uses'.format(
+            self.service_builds, self.service_build_seconds, self.service_gets)
+
+
+class WorkerPool(object):
+    def __init__(self, threads):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.stopping = threading.Event()
+        self.metrics = JobMetrics()
+        self._free = threads
+        self._cond = threading.Condition()
+
+    # Blocks until at least one thread is free (or we are stopping), and says how many are:
+    def wait_for_free(self):
+        with self._cond:
+            while self._free == 0 and not self.stopping.is_set():
+                self._cond.wait(1.0)
+            return self._free
+
+    # Claims a thread for a task, blocking until one is free. False if we are stopping instead:
+    def take_slot(self):
+        with self._cond:
+            while self._free == 0:
+                if self.stopping.is_set():
+                    return False
+                self._cond.wait(1.0)
+            self._free -= 1
+            return True
+
+    def _return_slot(self):
+        with self._cond:
+            self._free += 1
+            self._cond.notify_all()
+
+    def submit(self, q, task):
+        self.executor.submit(self._run, q, task)
+
+    def _run(self, q, task):
+        try:
+            started = time.time()
+            submitted_at = task.getMsg().get('submitted_at') or task.pulled_at or started
+            duplicate_of = handle_task(task)
+            if duplicate_of == 'running':
+                # The job is running on another worker. Keep the task (Pub/Sub redelivers it
+                # later) so the job can be claimed again if that worker dies:
+                q.release([task], delay=RECHECK_SECONDS)
+                return
+            acknowledge(q, task)
+            if task.getMsg().get('method') == 'buildWithParameters' and duplicate_of is None:
+                self.metrics.record(started - submitted_at, time.time() - started)
+        except Exception:
+            # Not acknowledged: hand it back so it is redelivered
+            traceback.print_exc()
+            try:
+                q.release([task])
+            except Exception:
+                traceback.print_exc()
+        finally:
+            self._return_slot()
+
+    def drain(self):
+        self.executor.shutdown(wait=True)
+        self.metrics.report()
+
+
+#
+# Jobs come in two ways: through Pub/Sub, which any worker on any host can pull from, and
+# through the local queue that the UDU server on this host also drops every job into. Pub/Sub
+# can sit on a lone message for many minutes, while the local queue is picked up in under a
+# second. One consumer thread per queue feeds the same pool; the job claim table makes sure
+# whichever copy of a job comes second is just a duplicate.
+#
+
+# Only the first connection checks that the topic exists. Reconnects run inside the retry
+# predicate of retry_pubsub, so they must not make Pub/Sub calls of their own:
+def connect_pubsub(check_topic=True):
+    pubsub_client = pubsub.Client(project=PROJECT_ID)
+    return Queue(pubsub_client, name=PSQ_TOPIC_NAME, check_topic=check_topic)
+
+
+# (Nothing to check for a local queue)
+def connect_local(check_topic=True):
+    return LocalQueue(LOCAL_QUEUE_DIR)
+
+
+def consume(pool, connect):
+    current = {}
+
+    def reconnect():
+        if current:
+            current['queue'].close()
+        current['queue'] = connect(check_topic=not current)
+        current['worker'] = Worker(current['queue'], max_messages=MAX_MESSAGES)
+
+    @retry_pubsub(reconnect)
+    def listen(max_messages):
+        current['worker'].max_messages = max_messages
+        return current['worker'].listen(pool.stopping) # will block until exception, a task, or SIGTERM
+
+    reconnect()
+    while not pool.stopping.is_set():
+        free = pool.wait_for_free()
+        if pool.stopping.is_set():
+            break
+        tasks = listen(min(free, MAX_MESSAGES)) or []
+        q = current['queue']
+
+        # Tasks stay leased until they are acknowledged, which happens only once they have been
+        # handled. If the worker dies mid-job, Pub/Sub redelivers the task. (The other consumer
+        # may have taken a free thread meanwhile; then the task waits here, still leased.)
+        for idx, task in enumerate(tasks):
+            if not pool.take_slot():
+                q.release(tasks[idx:])
+                break
+            pool.submit(q, task)
+    current['queue'].close()
+
+
+def main():
+    print >> sys.stderr, 'Not PSQ has Started for {0} with {1} worker threads'.format(PSQ_TOPIC_NAME, WORKER_THREADS)
+    if CLAIM_STALE_SECONDS >= RECHECK_SECONDS:
+        print >> sys.stderr, 'WARNING: job claims go stale after {0}s, not before duplicates are rechecked ({1}s): ' \
+                             'lower UDU_JOB_HEARTBEAT_SECONDS'.format(CLAIM_STALE_SECONDS, RECHECK_SECONDS)
+    pool = WorkerPool(WORKER_THREADS)
+    set_timing_hook(pool.metrics.record_service)
+    failed = []
+
+    def on_sigterm(signum, frame):
+        print >> sys.stderr, 'SIGTERM: draining at {0}'.format(str(datetime.now()))
+        pool.stopping.set()
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    def run_consumer(connect):
+        try:
+            consume(pool, connect)
+        except Exception:
+            # Stop taking work and exit once the running jobs are done; supervisord restarts us
+            traceback.print_exc()
+            failed.append(connect.__name__)
+            pool.stopping.set()
+
+    consumers = []
+    for connect in (connect_pubsub, connect_local):
+        consumer = threading.Thread(target=run_consumer, args=(connect,), name=connect.__name__)
+        consumer.start()
+        consumers.append(consumer)
+
+    # Signals only reach the main thread, so it just waits here:
+    while not pool.stopping.is_set():
+        time.sleep(1)
+    for consumer in consumers:
+        consumer.join()
+
+    pool.drain()
+    print >> sys.stderr, 'Not PSQ drained and stopped at {0}'.format(str(datetime.now()))
+    if failed:
+        sys.exit(1)
+
+
+def acknowledge(q, task):
+    try:
+        q.acknowledge([task])
+    except RetryError:
+        # Not fatal: the lease runs out and the task comes back as a (detected) duplicate
+        print >> sys.stderr, 'acknowledge failed for task {0}'.format(task.getID())
+
+
+def handle_task(task):
+    to_do = task.getMsg()
+    if 'method' not in to_do:
+        print >> sys.stderr, 'unexpected task contents: {0}'.format(to_do)
+    # Using 'is' here instead of == means no matches... because the string is built from bytes coming over the wire??
+    elif to_do['method'] == 'buildWithParameters':
+        print >> sys.stderr, 'Job {0} received at: {1}'.format(to_do['file_name'], str(datetime.now()))
+        duplicate_of = isb_cgc_user_data.uduprocessor.process_upload(to_do['file_name'], to_do['success_url'],
+                                                                     to_do['failure_url'], message_id=task.getID(),
+                                                                     submitted_at=to_do.get('submitted_at'))
+        print >> sys.stderr, 'Job {0} finished at: {1}'.format(to_do['file_name'], str(datetime.now()))
+        return duplicate_of
+    elif to_do['method'] == 'ping':
+        print >> sys.stderr, 'Pipe pinged at: {0}'.format(str(datetime.now()))
+    else:
+        print >> sys.stderr, 'unexpected method call: {0} at {1}'.format(to_do['method'], str(datetime.now()))
+
 
 if __name__ == '__main__':
     main()